@@ -0,0 +1,157 @@
+# Per-block protocol-wide skew, concentration and debt metrics across all markets.
+#
+# `transform_df()` attaches block totals to every market row with window sums over `block`. The engine below computes
+# protocol metrics once per block in a single group-by pass instead, and keeps them in a materialized table that only
+# aggregates newly appended blocks.
+
+import os
+
+from dataclasses import dataclass, field
+
+import polars as pl
+
+
+INPUT_COLUMNS = [
+    'block', 'timestamp', 'marketSize_usd', 'marketSkew_usd', 'marketDebt_usd', 'long_oi_usd', 'short_oi_usd',
+    'relative_market_skew',
+]
+
+
+def _ratio(numerator: pl.Expr, denominator: pl.Expr) -> pl.Expr:
+    """Float ratio, null instead of inf/NaN when the denominator is 0."""
+    return pl.when(denominator != 0).then(numerator.cast(pl.Float64) / denominator.cast(pl.Float64))
+
+
+def protocol_metric_exprs() -> list[pl.Expr]:
+    """
+    Aggregations computing protocol metrics for one block of market rows.
+
+    - `net_marketSkew_usd`: signed sum of skew, the protocol's net directional exposure.
+    - `gross_marketSkew_usd`: sum of absolute skew.
+    - `net_skew_ratio`: net / gross skew, between -1 (every market skewed short) and 1 (every market skewed long).
+    - `oi_hhi`: Herfindahl-Hirschman index of `marketSize_usd`, between 1 / n_markets and 1.
+    - `skew_hhi`: Herfindahl-Hirschman index of absolute skew, how concentrated the skew risk is.
+    - `debt_weighted_skew`: average `relative_market_skew` weighted by absolute `marketDebt_usd`.
+
+    Sums keep the input dtype, so exact `Decimal(38, 18)` inputs give exact totals. Ratios are Float64.
+    """
+    size = pl.col('marketSize_usd')
+    skew = pl.col('marketSkew_usd')
+    debt = pl.col('marketDebt_usd')
+
+    return [
+        pl.col('timestamp').first(),
+        pl.len().alias('n_markets'),
+        size.sum().alias('total_marketSize_usd'),
+        pl.col('long_oi_usd').sum().alias('total_long_oi_usd'),
+        pl.col('short_oi_usd').sum().alias('total_short_oi_usd'),
+        debt.sum().alias('total_marketDebt_usd'),
+        skew.sum().alias('net_marketSkew_usd'),
+        skew.abs().sum().alias('gross_marketSkew_usd'),
+        _ratio(skew.sum(), skew.abs().sum()).alias('net_skew_ratio'),
+        _ratio((size.cast(pl.Float64) ** 2).sum(), size.cast(pl.Float64).sum() ** 2).alias('oi_hhi'),
+        _ratio((skew.cast(pl.Float64) ** 2).sum(), skew.cast(pl.Float64).abs().sum() ** 2).alias('skew_hhi'),
+        _ratio(
+            (debt.cast(pl.Float64).abs() * pl.col('relative_market_skew').cast(pl.Float64)).sum(),
+            debt.cast(pl.Float64).abs().sum()
+        ).alias('debt_weighted_skew'),
+    ]
+
+
+def aggregate_blocks(df: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame | pl.LazyFrame:
+    """
+    Compute protocol metrics for every block of a frame with at least `INPUT_COLUMNS` in one group-by pass,
+    e.g. the output of `SNXMarketData.preprocess_market_summary_df()`. Lazy in, lazy out.
+
+    Returns:
+        One row per block, sorted by block, with `block` and the columns of `protocol_metric_exprs()`.
+    """
+    aggregates = df.lazy().group_by('block').agg(protocol_metric_exprs()).sort('block')
+    return aggregates.collect() if isinstance(df, pl.DataFrame) else aggregates
+
+
+@dataclass
+class ProtocolAggregates:
+    """
+    Materialized per-block protocol metrics table, updated incrementally as blocks are appended.
+
+    Only the appended rows are aggregated, so protocol-wide queries read one row per block instead of scanning every
+    market row. If `path` is set, the table is loaded from that parquet file on creation and written back by `save()`.
+
+    Usage:
+        aggregates = ProtocolAggregates('data/protocol_aggregates.parquet')
+        aggregates.append(snx_data.preprocess_market_summary_df(store.iter_snapshots(start=last_block + 1)))
+        aggregates.save()
+
+    - Note that each appended frame must contain every market row of its blocks. A block that is appended again
+    is replaced, not merged.
+    - Note that in-order appends add one chunk each. The table is rechunked once it holds `max_chunks` chunks, so
+    appends stay cheap and queries scan contiguous memory.
+    """
+    path: str = None
+    table: pl.DataFrame = field(default=None, repr=False)
+    max_chunks: int = 16
+
+    def __post_init__(self):
+        if self.table is None and self.path is not None and os.path.exists(self.path):
+            self.table = pl.read_parquet(self.path)
+        if self.table is not None:
+            self.table = self.table.rechunk()
+
+    @property
+    def last_block(self) -> int:
+        """Highest aggregated block, or `None` if the table is empty. The table is sorted by block."""
+        return None if self.table is None or self.table.is_empty() else self.table['block'][-1]
+
+    def append(self, df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Aggregate the blocks in `df` and merge them into the table. Blocks past `last_block` are appended as is,
+        older blocks replace their existing rows and the table is re-sorted.
+
+        Returns:
+            pl.DataFrame: The aggregates of the appended blocks.
+        """
+        new_blocks = aggregate_blocks(df)
+
+        if new_blocks.is_empty():
+            return new_blocks
+
+        if self.table is None or self.table.is_empty():
+            self.table = new_blocks
+        elif new_blocks['block'].min() > self.last_block:
+            # usual case of blocks appended in order, nothing to replace or re-sort
+            self.table = pl.concat([self.table, new_blocks], how='vertical_relaxed', rechunk=False)
+            if self.table.n_chunks() >= self.max_chunks:
+                self.table = self.table.rechunk()
+        else:
+            self.table = pl.concat([
+                self.table.join(new_blocks.select('block'), on='block', how='anti'),
+                new_blocks,
+            ], how='vertical_relaxed').sort('block').rechunk()
+
+        return new_blocks
+
+    def query(self, start_block: int = None, end_block: int = None) -> pl.DataFrame:
+        """
+        Return the aggregates with `start_block <= block <= end_block`.
+        """
+        if self.table is None:
+            return pl.DataFrame()
+
+        table = self.table
+        if start_block is not None:
+            table = table.filter(pl.col('block') >= start_block)
+        if end_block is not None:
+            table = table.filter(pl.col('block') <= end_block)
+        return table
+
+    def save(self, path: str = None):
+        """
+        Write the table to `path`, or to `self.path` if not given.
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path given to save protocol aggregates to.")
+        if self.table is not None:
+            self.table = self.table.rechunk()
+            self.table.write_parquet(path)
@@ -0,0 +1,309 @@
+# Rolling window analytics per market over snapshot histories.
+#
+# Every metric is the difference between a per-market running (cumulative) sum at the current sample and at the
+# window boundary. The batch path computes running sums with `cum_sum()` and finds boundaries with an as-of join, the
+# online path keeps the running sums and a deque of checkpoints per window. Both paths perform the same float
+# operations in the same order, so their results are identical.
+#
+# Window boundaries are snapped to a per-window grid of `checkpoints` cells: the boundary of a sample at `t` is the
+# last sample at or before `(t - window) // resolution * resolution`, so windows are up to one `resolution` longer
+# than their label. The online path then only needs to keep the last sample of each cell instead of every sample.
+#
+# Running sums never grow with history length. They restart at every epoch of two epoch systems, `a` and `b`, offset
+# by half an epoch. A sample uses the system whose current epoch started at least one window (plus resolution) ago,
+# so its boundary is either in the same epoch or before it, in which case the epoch started from zero sums. Skew is
+# accumulated relative to its first value of the epoch, which keeps the z-score variance free of cancellation when
+# the skew is large compared to its spread.
+#
+# Time weighted metrics weight each value by the time until the next sample, i.e. a sample's value holds until the
+# market is observed again.
+
+import math
+
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Iterable
+
+import polars as pl
+
+
+SECONDS_PER_DAY = 86400
+# polars turns division by a literal into multiplication by its reciprocal, do the same explicitly in both paths
+DAYS_PER_SECOND = 1 / SECONDS_PER_DAY
+
+WINDOWS = {
+    '1h': 3600,
+    '8h': 8 * 3600,
+    '24h': SECONDS_PER_DAY,
+    '7d': 7 * SECONDS_PER_DAY,
+}
+
+# boundary grid cells per window, i.e. the 1h window snaps to minutes
+CHECKPOINTS = 60
+
+INPUT_COLUMNS = [
+    'market', 'timestamp', 'price', 'marketSkew', 'currentFundingRate', 'yearlyFundingRate', 'long_oi_usd', 'short_oi_usd'
+]
+
+# running sums, in the order they are stored by the online state
+RUNNING_SUMS = ['_elapsed', '_price_time', '_apr_time', '_funding_accrued', '_count', '_skew', '_skew_sq']
+
+EPOCH_SYSTEMS = ['a', 'b']
+
+
+def metric_columns(windows: dict[str, int] = WINDOWS) -> list[str]:
+    """
+    Names of the columns added by `rolling_metrics()` and returned by `RollingAnalytics.update()`.
+
+    - `funding_apr_{w}`: time weighted average of `yearlyFundingRate`.
+    - `twap_{w}`: time weighted average `price`.
+    - `skew_zscore_{w}`: z-score of the current `marketSkew` against the samples in the window.
+    - `oi_change_usd_{w}`: change in gross open interest (`long_oi_usd - short_oi_usd`) since the window boundary.
+    - `funding_accrued_{w}`: funding accrued over the window, `currentFundingRate` is a 24hr rate.
+    """
+    return [
+        f'{metric}_{label}'
+        for label in windows
+        for metric in ('funding_apr', 'twap', 'skew_zscore', 'oi_change_usd', 'funding_accrued')
+    ]
+
+
+def checkpoint_resolutions(windows: dict[str, int] = WINDOWS, checkpoints: int = CHECKPOINTS) -> dict[str, int]:
+    """
+    Boundary grid resolution in seconds of each window, `window // checkpoints` but at least one second.
+    """
+    return {label: max(1, seconds // checkpoints) for label, seconds in windows.items()}
+
+
+def half_epoch_length(windows: dict[str, int] = WINDOWS, checkpoints: int = CHECKPOINTS) -> int:
+    """
+    Offset in seconds between the two epoch systems, the longest window plus its resolution. Epochs are twice as long.
+    """
+    resolutions = checkpoint_resolutions(windows, checkpoints)
+    return max(seconds + resolutions[label] for label, seconds in windows.items())
+
+
+def _window_sum(column: str, system: str) -> pl.Expr:
+    """Running sum `column` of `system` minus its value at the boundary, or zero if the boundary is in an earlier epoch."""
+    same_epoch = pl.col(f'_epoch_{system}_b') == pl.col(f'_epoch_{system}')
+    return pl.col(f'{column}_{system}') - pl.when(same_epoch).then(pl.col(f'{column}_{system}_b')).otherwise(0.0)
+
+
+def rolling_metrics(df: pl.DataFrame | pl.LazyFrame, windows: dict[str, int] = WINDOWS,
+                    checkpoints: int = CHECKPOINTS) -> pl.DataFrame | pl.LazyFrame:
+    """
+    Batch version of the rolling metrics. Adds `metric_columns(windows)` to a market summary history, e.g. the
+    output of `SNXMarketData.preprocess_market_summary_df()` for snapshots read from a `SnapshotStore`.
+
+    Args:
+        df (pl.DataFrame | pl.LazyFrame): Market summaries with at least `INPUT_COLUMNS`. Decimal columns are cast to Float64.
+        windows (dict[str, int]): Window labels and lengths in seconds. (Default: `WINDOWS`)
+        checkpoints (int): Boundary grid cells per window. (Default: `CHECKPOINTS`)
+
+    Returns:
+        The input rows sorted by `timestamp`, with metric columns added. Rows sharing a timestamp keep their input
+        order, so pass them in block order. Lazy in, lazy out.
+    """
+    lazy = df.lazy()
+    value_columns = INPUT_COLUMNS[2:]
+    resolutions = checkpoint_resolutions(windows, checkpoints)
+    half_epoch = half_epoch_length(windows, checkpoints)
+    epoch = 2 * half_epoch
+
+    # stable sort, samples sharing a timestamp (pre-Bedrock blocks) keep their input order like in the online path
+    running = lazy.sort('timestamp', maintain_order=True).with_columns(
+        [pl.col(c).cast(pl.Float64) for c in value_columns]
+    ).with_columns(
+        (pl.col('timestamp') - pl.col('timestamp').shift(1)).over('market').fill_null(0).cast(pl.Float64).alias('_dt'),
+        (pl.col('long_oi_usd') - pl.col('short_oi_usd')).alias('_oi'),
+        (pl.col('timestamp') // epoch).alias('_epoch_a'),
+        ((pl.col('timestamp') + half_epoch) // epoch).alias('_epoch_b'),
+        (pl.col('timestamp') % epoch >= half_epoch).alias('_use_a'),
+    ).with_columns(
+        (pl.col('price').shift(1).over('market') * pl.col('_dt')).fill_null(0.0).alias('_price_term'),
+        (pl.col('yearlyFundingRate').shift(1).over('market') * pl.col('_dt')).fill_null(0.0).alias('_apr_term'),
+        (pl.col('currentFundingRate').shift(1).over('market') * pl.col('_dt') * DAYS_PER_SECOND).fill_null(0.0).alias('_funding_term'),
+        pl.col('_oi').first().over('market').alias('_first_oi'),
+    )
+
+    for system in EPOCH_SYSTEMS:
+        group = ['market', f'_epoch_{system}']
+        skew = pl.col(f'_y_{system}')
+        running = running.with_columns(
+            (pl.col('marketSkew') - pl.col('marketSkew').first().over(group)).alias(f'_y_{system}')
+        ).with_columns(
+            pl.col('_dt').cum_sum().over(group).alias(f'_elapsed_{system}'),
+            pl.col('_price_term').cum_sum().over(group).alias(f'_price_time_{system}'),
+            pl.col('_apr_term').cum_sum().over(group).alias(f'_apr_time_{system}'),
+            pl.col('_funding_term').cum_sum().over(group).alias(f'_funding_accrued_{system}'),
+            pl.int_range(1, pl.len() + 1).over(group).cast(pl.Float64).alias(f'_count_{system}'),
+            skew.cum_sum().over(group).alias(f'_skew_{system}'),
+            (skew * skew).cum_sum().over(group).alias(f'_skew_sq_{system}'),
+        )
+
+    system_columns = [f'_epoch_{s}' for s in EPOCH_SYSTEMS] + [f'{c}_{s}' for s in EPOCH_SYSTEMS for c in RUNNING_SUMS]
+    boundary = running.select(
+        'market',
+        pl.col('timestamp').alias('_boundary_timestamp'),
+        *[pl.col(c).alias(f'{c}_b') for c in system_columns + ['_oi']],
+    )
+
+    for label, seconds in windows.items():
+        resolution = resolutions[label]
+        running = running.with_columns(
+            ((pl.col('timestamp') - seconds) // resolution * resolution).alias('_edge')
+        ).join_asof(
+            boundary, left_on='_edge', right_on='_boundary_timestamp', by='market', strategy='backward',
+            check_sortedness=False,  # sorted by timestamp above
+        ).with_columns(
+            [pl.when(pl.col('_use_a')).then(_window_sum(c, 'a')).otherwise(_window_sum(c, 'b')).alias(f'_w{c}') for c in RUNNING_SUMS]
+            + [pl.when(pl.col('_use_a')).then(pl.col('_y_a')).otherwise(pl.col('_y_b')).alias('_y')]
+            + [(pl.col('_oi') - pl.col('_oi_b').fill_null(pl.col('_first_oi'))).alias(f'oi_change_usd_{label}')]
+        ).with_columns(
+            ((pl.col('_w_skew_sq') - pl.col('_w_skew') * pl.col('_w_skew') / pl.col('_w_count')) / (pl.col('_w_count') - 1)).alias('_var'),
+        ).with_columns(
+            pl.when(pl.col('_w_elapsed') > 0).then(pl.col('_w_apr_time') / pl.col('_w_elapsed')).alias(f'funding_apr_{label}'),
+            pl.when(pl.col('_w_elapsed') > 0).then(pl.col('_w_price_time') / pl.col('_w_elapsed')).alias(f'twap_{label}'),
+            pl.when((pl.col('_w_count') > 1) & (pl.col('_var') > 0)).then(
+                (pl.col('_y') - pl.col('_w_skew') / pl.col('_w_count')) / pl.col('_var').sqrt()
+            ).alias(f'skew_zscore_{label}'),
+            pl.col('_w_funding_accrued').alias(f'funding_accrued_{label}'),
+        ).drop(
+            ['_edge', '_boundary_timestamp', '_var', '_y']
+            + [f'{c}_b' for c in system_columns + ['_oi']]
+            + [f'_w{c}' for c in RUNNING_SUMS]
+        )
+
+    running = running.drop(
+        ['_dt', '_oi', '_first_oi', '_use_a', '_price_term', '_apr_term', '_funding_term']
+        + system_columns + [f'_y_{s}' for s in EPOCH_SYSTEMS]
+    )
+
+    return running.collect() if isinstance(df, pl.DataFrame) else running
+
+
+@dataclass
+class _MarketState:
+    """Running sums and window checkpoints of a single market."""
+    timestamp: int
+    price: float
+    yearlyFundingRate: float
+    currentFundingRate: float
+    first_oi: float
+    epochs: list  # current epoch per system
+    anchors: list  # first skew of the current epoch per system
+    sums: list  # running sums per system, replaced on every update and never mutated
+    checkpoints: dict = field(default_factory=dict)  # label -> deque of (cell, (timestamp, epochs, sums, oi))
+
+
+@dataclass
+class RollingAnalytics:
+    """
+    Online version of `rolling_metrics()`. Feed it one block at a time and it returns the metrics of every market in
+    that block, in O(1) amortized time per market and window.
+
+    Usage:
+        analytics = RollingAnalytics()
+        for snapshot in store.iter_snapshots():
+            metrics = analytics.update(snx_data.preprocess_market_summary_snapshot(snapshot))
+
+    - Note that each window keeps at most `checkpoints + 2` entries per market, the last sample of each grid cell,
+      whatever the sample rate.
+    """
+    windows: dict = field(default_factory=lambda: dict(WINDOWS))
+    checkpoints: int = CHECKPOINTS
+    _markets: dict = field(default_factory=dict, repr=False)
+
+    def __post_init__(self):
+        self._resolutions = checkpoint_resolutions(self.windows, self.checkpoints)
+        self._half_epoch = half_epoch_length(self.windows, self.checkpoints)
+        self._epoch = 2 * self._half_epoch
+
+    def update(self, markets: Iterable) -> list[dict]:
+        """
+        Add one block of market summaries and return the metrics of each market.
+
+        Args:
+            markets: `SNXMarketSummaryStruct` objects or dicts with at least `INPUT_COLUMNS`, all for the same block.
+                Samples of a market must arrive in increasing timestamp order.
+
+        Returns:
+            list[dict]: `market`, `timestamp` and `metric_columns(self.windows)` for each market.
+        """
+        return [self._update_market(m.to_dict() if hasattr(m, 'to_dict') else m) for m in markets]
+
+    def reset(self):
+        self._markets.clear()
+
+    def _update_market(self, row: dict) -> dict:
+        timestamp = row['timestamp']
+        price = float(row['price'])
+        skew = float(row['marketSkew'])
+        yearly_funding_rate = float(row['yearlyFundingRate'])
+        funding_rate = float(row['currentFundingRate'])
+        oi = float(row['long_oi_usd']) - float(row['short_oi_usd'])
+
+        state = self._markets.get(row['market'])
+
+        if state is None:
+            state = _MarketState(timestamp, price, yearly_funding_rate, funding_rate, oi, [None, None], [0.0, 0.0], [None, None])
+            state.checkpoints = {label: deque() for label in self.windows}
+            self._markets[row['market']] = state
+            dt = 0.0
+            terms = [0.0, 0.0, 0.0, 0.0]
+        else:
+            dt = float(timestamp - state.timestamp)
+            terms = [dt, state.price * dt, state.yearlyFundingRate * dt, state.currentFundingRate * dt * DAYS_PER_SECOND]
+
+        epochs = (timestamp // self._epoch, (timestamp + self._half_epoch) // self._epoch)
+        for i, epoch in enumerate(epochs):
+            if epoch != state.epochs[i]:
+                state.epochs[i] = epoch
+                state.anchors[i] = skew
+                state.sums[i] = [0.0] * len(RUNNING_SUMS)
+            y = skew - state.anchors[i]
+            # same order as RUNNING_SUMS
+            state.sums[i] = [s + t for s, t in zip(state.sums[i], terms + [1.0, y, y * y])]
+
+        state.timestamp = timestamp
+        state.price = price
+        state.yearlyFundingRate = yearly_funding_rate
+        state.currentFundingRate = funding_rate
+
+        checkpoint = (timestamp, epochs, tuple(state.sums), oi)
+        system = 0 if timestamp % self._epoch >= self._half_epoch else 1
+        y = skew - state.anchors[system]
+
+        result = {'market': row['market'], 'timestamp': timestamp}
+
+        for label, seconds in self.windows.items():
+            resolution = self._resolutions[label]
+            entries = state.checkpoints[label]
+            cell = -(-timestamp // resolution)
+            if entries and entries[-1][0] == cell:
+                entries[-1] = (cell, checkpoint)
+            else:
+                entries.append((cell, checkpoint))
+
+            edge = (timestamp - seconds) // resolution * resolution
+            while len(entries) > 1 and entries[1][1][0] <= edge:
+                entries.popleft()
+            boundary = entries[0][1] if entries[0][1][0] <= edge else None
+
+            if boundary is not None and boundary[1][system] == epochs[system]:
+                boundary_sums = boundary[2][system]
+            else:
+                boundary_sums = [0.0] * len(RUNNING_SUMS)
+
+            elapsed, price_time, apr_time, funding_accrued, count, skew_sum, skew_sq = (
+                s - b for s, b in zip(state.sums[system], boundary_sums)
+            )
+            var = (skew_sq - skew_sum * skew_sum / count) / (count - 1) if count > 1 else None
+
+            result[f'funding_apr_{label}'] = apr_time / elapsed if elapsed > 0 else None
+            result[f'twap_{label}'] = price_time / elapsed if elapsed > 0 else None
+            result[f'skew_zscore_{label}'] = (y - skew_sum / count) / math.sqrt(var) if var is not None and var > 0 else None
+            result[f'oi_change_usd_{label}'] = oi - (boundary[3] if boundary is not None else state.first_oi)
+            result[f'funding_accrued_{label}'] = funding_accrued
+
+        return result
@@ -0,0 +1,54 @@
+# Helper module to keep on-chain 18 decimal fixed-point values exact in polars dataframes.
+
+import polars as pl
+
+from decimal import Decimal
+
+
+SNX_DECIMAL_PLACES = 18
+FIXED_POINT = pl.Decimal(38, SNX_DECIMAL_PLACES)  # 20 integer digits, 18 fractional digits
+
+
+def fixed_point_lit(value) -> pl.Expr:
+    """
+    Return a `Decimal(38, 18)` literal. Use this instead of float literals in exact expressions, a float literal
+    silently promotes the whole expression to Float64.
+    """
+    return pl.lit(Decimal(str(value)), dtype=FIXED_POINT)
+
+
+def scale_fixed_point(columns: list[str], exact: bool = True) -> list[pl.Expr]:
+    """
+    Expressions that scale raw `Int128` fixed-point columns in one vectorized pass.
+
+    Args:
+        columns (list[str]): Names of columns holding raw on-chain integers.
+        exact (bool): If True, columns become `Decimal(38, 18)` without any loss of precision.
+            If False, columns become Float64 like the legacy `value / SNX_DECIMALS` conversion.
+    """
+    if exact:
+        # decimal[38,0] * decimal[38,18] keeps every digit of the raw integer, a direct cast would not.
+        unit = pl.lit(Decimal(1).scaleb(-SNX_DECIMAL_PLACES), dtype=FIXED_POINT)
+        return [(pl.col(c).cast(pl.Decimal(38, 0)) * unit).alias(c) for c in columns]
+
+    return [(pl.col(c).cast(pl.Float64) / 10**SNX_DECIMAL_PLACES).alias(c) for c in columns]
+
+
+def raw_to_df(rows: list[dict], columns: list[str], exact: bool = True, schema: dict = None) -> pl.DataFrame:
+    """
+    Build a dataframe from raw contract output and scale the fixed-point `columns`.
+
+    Raw values are loaded as `Int128` so values above 2**63 (e.g. `marketDebt`, large sizes) are not truncated.
+    `schema` gives the types of the other columns, so that empty `rows` still give a frame with every column.
+    """
+    schema = {**(schema or {}), **{c: pl.Int128 for c in columns}}
+    df = pl.DataFrame(rows, schema_overrides=schema) if rows else pl.DataFrame(schema=schema)
+    return df.with_columns(scale_fixed_point(columns, exact))
+
+
+def safe_divide(numerator: pl.Expr, denominator: pl.Expr) -> pl.Expr:
+    """
+    Decimal division raises on a zero denominator instead of returning inf/NaN like floats do.
+    Rows with a zero denominator become null.
+    """
+    return numerator / pl.when(denominator != 0).then(denominator)
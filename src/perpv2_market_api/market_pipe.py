@@ -1,3 +1,4 @@
+import asyncio
 import json
 import polars as pl
 import requests
@@ -9,26 +10,62 @@ from dotenv import load_dotenv
 from dataclasses import dataclass
 from perpv2_market_api.struct_parser import extract_names, flatten_list
 from perpv2_market_api.data_structs import SNXMarketSummaryStruct, PerpV2Directory, MarketDetails
-from typing import List
+from perpv2_market_api.fixed_point import FIXED_POINT, fixed_point_lit, raw_to_df, safe_divide
+from perpv2_market_api.request_cache import ContractRegistry, SnapshotCache
+from typing import Callable, List
 from web3 import Web3
 
 
 SNX_DECIMALS = 10**18
+MARKET_DATA_ADDRESS = "0x340B5d664834113735730Ad4aFb3760219Ad9112"  # PerpV2MarketData
+MARKET_DATA_ABI = "abi/PerpsV2MarketData.json"
+
+# raw uint256/int256 outputs that are 18 decimal fixed-point values
+MARKET_SUMMARY_FIXED_POINT_FIELDS = [
+    'maxLeverage', 'price', 'marketSize', 'marketSkew', 'marketDebt', 'currentFundingRate', 'currentFundingVelocity',
+    'takerFee', 'makerFee', 'takerFeeDelayedOrder', 'makerFeeDelayedOrder', 'takerFeeOffchainDelayedOrder',
+    'makerFeeOffchainDelayedOrder',
+]
+MARKET_DETAILS_FIXED_POINT_FIELDS = [
+    'takerFee', 'makerFee', 'takerFeeDelayedOrder', 'makerFeeDelayedOrder', 'takerFeeOffchainDelayedOrder',
+    'makerFeeOffchainDelayedOrder', 'maxLeverage', 'maxMarketValue', 'maxFundingVelocity', 'skewScale', 'marketSize',
+    'long', 'short', 'marketDebt', 'marketSkew', 'price',
+]
+
+# raw column types of the remaining outputs, so empty results still give a frame with every column
+MARKET_SUMMARY_SCHEMA = {
+    'market': pl.String, 'asset': pl.Binary, 'key': pl.Binary, 'block': pl.Int64, 'timestamp': pl.Int64,
+}
+MARKET_DETAILS_SCHEMA = {'market': pl.String, 'baseAsset': pl.Binary, 'marketKey': pl.Binary, 'invalid': pl.Boolean}
+
+
+def decode_bytes32(column: str) -> pl.Expr:
+    """
+    Vectorized version of `value.decode("utf-8").split('\\x00')[0]` for bytes32 columns.
+    """
+    return pl.col(column).cast(pl.String).str.split('\x00').list.first().alias(column)
 
 
 @dataclass
 class SNXMarketPipe:
     """
     SNXMarket calls external functions from Synthetix V2 contracts. Data is minimally processed and saved as dataclasses
+
+    ABIs, contract objects and the snapshot cache are class attributes, so they are shared by every pipe in the process.
     """
     load_dotenv()
     node = Web3(Web3.HTTPProvider(os.getenv("OPTIMISM_RPC")))
+    contracts = ContractRegistry()
+    snapshot_cache = SnapshotCache()
 
     def get_all_market_summaries(self, block: int = 0) -> dict[str]:
         """
         get_all_market_summaries() retrieves a summary of SNX V2 market data from the PerpetualsV2MarketData contract
         for a given block and timestamp.
 
+        Concurrent identical requests share one in-flight RPC call. Historical blocks are memoized, the latest block
+        for a short TTL, see `SnapshotCache`. Each caller gets its own copy.
+
         Args:
             block (int): The historical block number to retrieve data from. If 0, the most recent block
                                     will be used. (Default: 0)
@@ -36,16 +73,101 @@ class SNXMarketPipe:
         Returns:
             dict: A dictionary containing block, timestamp, and a list of market data dictionaries.
         """
-        file: str = os.path.abspath("abi/PerpsV2MarketData.json")
+        return self._cached(('allMarketSummaries',), block, self._get_all_market_summaries)
+
+    def get_market_details(self, market: str, block: int = 0, ) -> dict[str]:
+        """
+        Retrieves details of a specific market from the PerpV2MarketData contract.
+
+        Concurrent identical requests share one in-flight RPC call. Historical blocks are memoized, the latest block
+        for a short TTL, see `SnapshotCache`. Each caller gets its own copy.
+
+        Args:
+            market (str, optional): The market identifier for retrieving details.
+            block (int, optional): The historical block number to query data from.
+                Defaults to the latest block.
+
+        Returns:
+            dict: A dictionary with the following keys:
+                - "block": The block number from which the data was retrieved.
+                - "timestamp": The timestamp (Unix time) of the retrieved block.
+                - "market_details": A dictionary with market details. Keys correspond to output names
+                                    from the contract's ABI, and values represent corresponding data.
+
+        Raises:
+            FileNotFoundError: If the ABI file for the PerpsV2MarketData contract is not found.
+            ConnectionError: If there is an issue connecting to the Ethereum node.
+            ValueError: If the specified block is less than 0.
+            KeyError: If the market identifier (market) is not found in the contract.
+            Exception: For any other unexpected errors during the contract function call.
+        """
+        return self._cached(('marketDetails', market), block, lambda b: self._get_market_details(market, b))
+
+    def get_market_summaries(self, market_keys: list[str], block: int = 0) -> dict[str]:
+        """
+        Retrieves summaries of selected markets from the PerpV2MarketData contract in a single call.
+
+        Concurrent identical requests share one in-flight RPC call. Historical blocks are memoized, the latest block
+        for a short TTL, see `SnapshotCache`. Each caller gets its own copy.
 
-        with open(file) as f:
-            abi = json.load(f)
+        Args:
+            market_keys (list[str]): Market keys to query, e.g. `['sETHPERP', 'sBTCPERP']`.
+            block (int): The historical block number to retrieve data from. If 0, the most recent block
+                                    will be used. (Default: 0)
 
-        contract = self.node.eth.contract(
-            address="0x340B5d664834113735730Ad4aFb3760219Ad9112",  # PerpV2MarketData
-            abi=abi
+        Returns:
+            dict: A dictionary containing block, timestamp, and a list of market data dictionaries, in the same
+                format as `get_all_market_summaries()`.
+        """
+        return self._cached(
+            ('marketSummariesForKeys', tuple(market_keys)), block, lambda b: self._get_market_summaries(market_keys, b)
         )
 
+    async def get_all_market_summaries_async(self, block: int = 0) -> dict[str]:
+        """
+        Coroutine version of `get_all_market_summaries()`. The RPC call runs in a worker thread, so coroutines and
+        threads asking for the same block share one call.
+        """
+        return await asyncio.to_thread(self.get_all_market_summaries, block)
+
+    async def get_market_details_async(self, market: str, block: int = 0) -> dict[str]:
+        """
+        Coroutine version of `get_market_details()`.
+        """
+        return await asyncio.to_thread(self.get_market_details, market, block)
+
+    async def get_market_summaries_async(self, market_keys: list[str], block: int = 0) -> dict[str]:
+        """
+        Coroutine version of `get_market_summaries()`.
+        """
+        return await asyncio.to_thread(self.get_market_summaries, market_keys, block)
+
+    def cache_stats(self) -> dict:
+        """
+        Returns hit, miss and coalesce counters of the snapshot cache together with the number of ABI loads
+        and contract constructions done by the contract registry.
+        """
+        stats = self.snapshot_cache.stats.to_dict()
+        stats['abi_loads'] = self.contracts.stats.abi_loads
+        stats['contract_builds'] = self.contracts.stats.contract_builds
+        return stats
+
+    def _cached(self, key: tuple, block: int, fn: Callable[[int], dict]) -> dict:
+        """
+        Serve `fn(block)` through the snapshot cache, keyed by `key` and the block. A latest block result (`block=0`)
+        is also keyed by the block it resolved to.
+        """
+        if block == 0:
+            return self.snapshot_cache.get_or_call(key + (0,), lambda: fn(0), latest_key=lambda result: key + (result['block'],))
+        return self.snapshot_cache.get_or_call(key + (block,), lambda: fn(block))
+
+    def _get_all_market_summaries(self, block: int = 0) -> dict[str]:
+        """
+        Uncached `allMarketSummaries` call, see `get_all_market_summaries()`.
+        """
+        abi = self.contracts.get_abi(MARKET_DATA_ABI)
+        contract = self.contracts.get_contract(self.node, MARKET_DATA_ADDRESS, MARKET_DATA_ABI)
+
         block, timestamp = self._get_block(block)
 
         MAX_RETRIES = 15
@@ -53,6 +175,7 @@ class SNXMarketPipe:
         for retry in range(MAX_RETRIES):
             try:
                 output_data = contract.functions.allMarketSummaries().call(block_identifier=block)
+                break
             except ValueError as ve:
                 if 'timeout' in str(ve).lower() and retry < MAX_RETRIES - 1:
                     # print the ValueError
@@ -78,38 +201,33 @@ class SNXMarketPipe:
             "results": flattened_data_array
         }
 
-    def get_market_details(self, market: str, block: int = 0, ) -> dict[str]:
+    def _get_market_summaries(self, market_keys: list[str], block: int = 0) -> dict[str]:
         """
-        Retrieves details of a specific market from the PerpV2MarketData contract.
+        Uncached `marketSummariesForKeys` call, see `get_market_summaries()`.
+        """
+        abi = self.contracts.get_abi(MARKET_DATA_ABI)
+        contract = self.contracts.get_contract(self.node, MARKET_DATA_ADDRESS, MARKET_DATA_ABI)
 
-        Args:
-            market (str, optional): The market identifier for retrieving details.
-            block (int, optional): The historical block number to query data from.
-                Defaults to the latest block.
+        block, timestamp = self._get_block(block)
 
-        Returns:
-            dict: A dictionary with the following keys:
-                - "block": The block number from which the data was retrieved.
-                - "timestamp": The timestamp (Unix time) of the retrieved block.
-                - "market_details": A dictionary with market details. Keys correspond to output names
-                                    from the contract's ABI, and values represent corresponding data.
+        keys = [key.encode('utf-8').ljust(32, b'\x00') for key in market_keys]
+        output_data = contract.functions.marketSummariesForKeys(keys).call(block_identifier=block)
 
-        Raises:
-            FileNotFoundError: If the ABI file for the PerpsV2MarketData contract is not found.
-            ConnectionError: If there is an issue connecting to the Ethereum node.
-            ValueError: If the specified block is less than 0.
-            KeyError: If the market identifier (market) is not found in the contract.
-            Exception: For any other unexpected errors during the contract function call.
-        """
-        file = os.path.abspath("abi/PerpsV2MarketData.json")
+        # extract function output names from abi.
+        names = extract_names(abi, 'marketSummariesForKeys')
 
-        with open(file) as f:
-            abi = json.load(f)
+        return {
+            "block": block,
+            "timestamp": timestamp,
+            "results": [dict(zip(names, flatten_list(market))) for market in output_data]
+        }
 
-        contract = self.node.eth.contract(
-            address="0x340B5d664834113735730Ad4aFb3760219Ad9112",  # PerpV2MarketData
-            abi=abi
-        )
+    def _get_market_details(self, market: str, block: int = 0) -> dict[str]:
+        """
+        Uncached `marketDetails` call, see `get_market_details()`.
+        """
+        abi = self.contracts.get_abi(MARKET_DATA_ABI)
+        contract = self.contracts.get_contract(self.node, MARKET_DATA_ADDRESS, MARKET_DATA_ABI)
 
         block, timestamp = self._get_block(block)
 
@@ -122,9 +240,6 @@ class SNXMarketPipe:
         # Flatten the tuples in the list
         flattened_data = flatten_list(output_data)
 
-        # print(f"names length: {len(names)}")
-        # print(f"length of flattened data: {len(flattened_data)}")
-
         # create a dictionary from names and flattened_data
         flattened_market_details = dict(zip(names, flattened_data))
 
@@ -189,20 +304,37 @@ class SNXMarketPipe:
                 perps_address_list.append(perpv2_directory)
         return perps_address_list
 
+    def market_param_df(self, exact: bool = True) -> pl.DataFrame:
+        """
+        Dataframe version of `update_market_param_df()`. Fixed-point values are scaled in one vectorized pass,
+        and the frame can be joined on `marketKey` and passed to `SNXMarketData.transform_df()`.
+
+        Args:
+            exact (bool): If True, fixed-point values are kept exact as `Decimal(38, 18)` columns. If False they are
+                Float64 columns. (Default: True)
+        """
+        perps_addresses_list = self.load_proxy_perp_addresses()
+
+        raw_market_details = [self.get_market_details(market=market.address)['results'] for market in perps_addresses_list]
+
+        return raw_to_df(raw_market_details, MARKET_DETAILS_FIXED_POINT_FIELDS, exact, MARKET_DETAILS_SCHEMA).with_columns(
+            decode_bytes32('baseAsset'),
+            decode_bytes32('marketKey'),
+        )
+
     def update_market_param_df(self) -> List[MarketDetails]:
         """
         Call this periodically to retrieve a list of the most up to date market parameters. Loops through
-        all market addresses and returns `List[pl.DataFrame]`
+        all market addresses and returns `List[MarketDetails]`. See `market_param_df()` for exact values.
         """
 
         perps_addresses_list = self.load_proxy_perp_addresses()
 
-        final_data = []
+        raw_market_details = [self.get_market_details(market=market.address)['results'] for market in perps_addresses_list]
 
-        for market in perps_addresses_list:
-            raw_data = self.get_market_details(market=market.address)
-            market_summary = self.clean_market_details(raw_data['results'])
+        final_data = []
 
+        for market_summary in raw_market_details:
             # preprocess market parameters
             # - Decodes bytedata into strings
             # - Applies decimal converesion
@@ -246,11 +378,11 @@ class SNXMarketPipe:
         while not isinstance(num, int):
             match block_num:
                 case 0:
-                    num = self.node.eth.get_block('latest').number
-                    timestamp = self.node.eth.get_block('latest').timestamp
+                    header = self.node.eth.get_block('latest')
                 case _:
-                    num = self.node.eth.get_block(block_num).number
-                    timestamp = self.node.eth.get_block(block_num).timestamp
+                    header = self.node.eth.get_block(block_num)
+            num = header.number
+            timestamp = header.timestamp
 
         return num, timestamp
 
@@ -277,6 +409,15 @@ class SNXMarketData:
 
         market_data = self.pipe.get_all_market_summaries(block)
 
+        return self.preprocess_market_summary_snapshot(market_data)
+
+    def preprocess_market_summary_snapshot(self, market_data: dict) -> list[SNXMarketSummaryStruct]:
+        """
+        Process a raw snapshot, as returned by `SNXMarketPipe.get_all_market_summaries()` or read back from a
+        `SnapshotStore`, into `list[MarketSummaryStruct]`.
+
+        - Note that legacy perp v1 markets are filtered out automatically.
+        """
         market_summary_array = []
 
         for market in market_data['results']:
@@ -317,18 +458,94 @@ class SNXMarketData:
             makerFeeOffchainDelayedOrder=market_data['makerFeeOffchainDelayedOrder'] / SNX_DECIMALS
         )
 
-    def transform_df(self, snx_market_df: pl.DataFrame) -> pl.DataFrame:
+    def preprocess_market_summary_df(self, market_data: dict | list[dict], exact: bool = True) -> pl.DataFrame:
+        """
+        Vectorized version of `preprocess_market_summary_snapshot()`. Processes one or more raw snapshots into a
+        dataframe with the same columns as `SNXMarketSummaryStruct.to_dict()`.
+
+        Args:
+            market_data (dict | list[dict]): Raw snapshot(s), as returned by `SNXMarketPipe.get_all_market_summaries()`
+                or read back from a `SnapshotStore`.
+            exact (bool): If True, fixed-point values are kept exact as `Decimal(38, 18)` columns. If False they are
+                Float64 columns. (Default: True)
+
+        - Note that legacy perp v1 markets are filtered out automatically.
+        """
+        snapshots = [market_data] if isinstance(market_data, dict) else market_data
+
+        rows = [
+            {**market, 'block': snapshot['block'], 'timestamp': snapshot['timestamp']}
+            for snapshot in snapshots
+            for market in snapshot['results']
+        ]
+
+        df = raw_to_df(rows, MARKET_SUMMARY_FIXED_POINT_FIELDS, exact, MARKET_SUMMARY_SCHEMA).with_columns(
+            decode_bytes32('asset'),
+            decode_bytes32('key'),
+        )
+
+        # filters out perp v1 legacy markets
+        df = df.filter(pl.col('key').str.ends_with('PERP'))
+
+        resample_freq = fixed_point_lit(24 / 8) if exact else 24 / 8
+
+        # mirrors SNXMarketSummaryStruct.__post_init__()
+        df = df.with_columns(
+            (pl.col('currentFundingRate') / resample_freq).alias('eightHrFundingRate'),
+            (pl.col('currentFundingVelocity') / resample_freq).alias('eightHrFundingVelocity'),
+            (pl.col('currentFundingRate') * 365 * 100).alias('yearlyFundingRate'),
+            ((pl.col('marketSize') + pl.col('marketSkew')) / 2).alias('long_oi'),
+            safe_divide(pl.col('marketSkew'), pl.col('marketSize')).fill_null(0).alias('relative_market_skew'),
+        ).with_columns(
+            (pl.col('marketSkew') - pl.col('long_oi')).alias('short_oi'),
+        ).with_columns(
+            (pl.col('price') * pl.col('marketSize')).alias('marketSize_usd'),
+            (pl.col('price') * pl.col('marketSkew')).alias('marketSkew_usd'),
+            (pl.col('price') * pl.col('marketDebt')).alias('marketDebt_usd'),
+            (pl.col('price') * pl.col('long_oi')).alias('long_oi_usd'),
+            (pl.col('price') * pl.col('short_oi')).alias('short_oi_usd'),
+        )
+
+        return df.select(list(SNXMarketSummaryStruct.__dataclass_fields__))
+
+    def transform_df(self, snx_market_df: pl.DataFrame, exact: bool = False) -> pl.DataFrame:
         """
         `transform_df() is the major preprocessing dataframe step for Synthetix to obtain price impact and usd values. Adds
         - `premium_0`, `executionPrice`, `price_impact_full_rebalance`, `relative_market_skew_corrected_percent`, 
-        `total_marketSize_usd`, `marketSkew_usd`, `proportional_marketSize_usd`, `proportional_marketSkew_usd`
+        `relative_market_skew_usd`, `total_marketSize_usd`, `marketSkew_usd`, `gross_marketSkew_usd`,
+        `proportional_marketSize_usd`, `proportional_marketSkew_usd`, `proportional_gross_marketSkew_usd`
+
+        If `exact` is True, the fixed-point version of every calculation is used. Input columns must be Decimal,
+        e.g. from `preprocess_market_summary_df()` joined with `SNXMarketPipe.market_param_df()`, and are
+        cast to `Decimal(38, 18)`. Ratios with a zero denominator are null instead of inf/NaN.
+
+        Raises:
+            TypeError: If `exact` is True and an input column is not Decimal. Casting floats would carry their
+                representation error into the exact result, and raw on-chain integers are scaled by 1e18, so casting
+                them would give values 1e18 times too large. Scale raw integers with `scale_fixed_point()` first.
         """
+        divide = safe_divide if exact else (lambda a, b: a / b)
+        half = fixed_point_lit(0.5) if exact else 0.5
+
+        if exact:
+            inputs = [
+                "price", "marketSkew", "marketSize", "currentFundingVelocity", "marketSize_usd", "marketSkew_usd",
+                "long_oi_usd", "short_oi_usd", "skewScale", "maxMarketValue",
+            ]
+            non_decimal = {c: str(snx_market_df.schema[c]) for c in inputs if not snx_market_df.schema[c].is_decimal()}
+            if non_decimal:
+                raise TypeError(
+                    f"transform_df(exact=True) requires Decimal columns, got {non_decimal}. Use "
+                    "SNXMarketPipe.market_param_df() for exact market params and scale_fixed_point() for raw integers."
+                )
+            snx_market_df = snx_market_df.with_columns([pl.col(c).cast(FIXED_POINT) for c in inputs])
+
         # calculate price impact here
         snx_market_df = snx_market_df.with_columns(
             [
                 # price impact function
                 (
-                    (pl.col("marketSkew") / pl.col("skewScale")).alias("premium_0")
+                    divide(pl.col("marketSkew"), pl.col("skewScale")).alias("premium_0")
                 ),  # premium is a percent value based on `skewScale`
             ]
         )
@@ -337,7 +554,7 @@ class SNXMarketData:
             [
                 # executionPrice
                 (
-                    (pl.col("price") * (1 + 0.5 * (pl.col("premium_0") + 0))).alias(
+                    (pl.col("price") * (1 + half * (pl.col("premium_0") + 0))).alias(
                         "executionPrice"
                     )
                 ),  # premium_1 equals 0 when skew is completely rebalanced. On polynomial, this is the 'current price'. Index price is the pyth price.
@@ -346,7 +563,7 @@ class SNXMarketData:
 
         snx_market_df = snx_market_df.with_columns(
             [
-                (((pl.col("executionPrice") - pl.col("price")) / pl.col("price"))).alias(
+                (divide(pl.col("executionPrice") - pl.col("price"), pl.col("price"))).alias(
                     "price_impact_full_rebalance"
                 ),
             ]
@@ -360,8 +577,8 @@ class SNXMarketData:
                 (pl.col("currentFundingVelocity") * 365 * 100).alias(
                     "yearlyFundingVelocity"
                 ),  # ? Could be a useful metric to implement into pipeline (8/18/23)
-                # ((pl.col("relative_market_skew") * pl.col("price"))).alias("relative_market_skew_usd"),                       # ! why doesn't this automatically calculate in pipeline? (8/18/23)
-                (pl.col("marketSkew") / pl.col("marketSize")).alias(
+                (pl.col("relative_market_skew") * pl.col("price")).alias("relative_market_skew_usd"),
+                divide(pl.col("marketSkew"), pl.col("marketSize")).alias(
                     "relative_market_skew_corrected_percent"
                 ),
             ]
@@ -384,6 +601,14 @@ class SNXMarketData:
                     .over("block")
                     .alias("total_marketSkew_usd")
                 ),
+                # gross_marketSkew_usd, sum of absolute skew
+                (
+                    pl.col("marketSkew_usd")
+                    .abs()
+                    .sum()
+                    .over("block")
+                    .alias("gross_marketSkew_usd")
+                ),
                 # total_longs_usd
                 (pl.col("long_oi_usd").sum().over("block").alias("total_long_oi_usd")),
                 # total_shorts_usd
@@ -394,17 +619,21 @@ class SNXMarketData:
         # - proportional market stats (in USD) - proportional to total/aggregate market stats
         snx_market_df = snx_market_df.with_columns(
             [
-                (pl.col("marketSize_usd") / pl.col("total_marketSize_usd")).alias(
+                divide(pl.col("marketSize_usd"), pl.col("total_marketSize_usd")).alias(
                     "proportional_marketSize_usd"
                 ),
                 # not sure proportional market skew makes sense as a calculation. Probably better to stick to relative market skew usd
-                (pl.col("marketSkew_usd") / pl.col("total_marketSkew_usd")).alias(
+                divide(pl.col("marketSkew_usd"), pl.col("total_marketSkew_usd")).alias(
                     "proportional_marketSkew_usd"
                 ),  # ! marketSkew_usd in denominator is messing up this calculation because marketSkew has both negative and positive values.
-                (pl.col("long_oi_usd") / pl.col("total_long_oi_usd")).alias(
+                # share of the protocol's gross skew, between 0 and 1
+                divide(pl.col("marketSkew_usd").abs(), pl.col("gross_marketSkew_usd")).alias(
+                    "proportional_gross_marketSkew_usd"
+                ),
+                divide(pl.col("long_oi_usd"), pl.col("total_long_oi_usd")).alias(
                     "proportional_long_oi_usd"
                 ),
-                (pl.col("short_oi_usd") / pl.col("total_short_oi_usd")).alias(
+                divide(pl.col("short_oi_usd"), pl.col("total_short_oi_usd")).alias(
                     "proportional_short_oi_usd"
                 ),
             ]
@@ -414,7 +643,7 @@ class SNXMarketData:
         snx_market_df = snx_market_df.with_columns(
             [
                 (pl.col("maxMarketValue").alias("maxMarketValue_usd")),
-                (pl.col("skewScale") / pl.col("maxMarketValue")).alias(
+                divide(pl.col("skewScale"), pl.col("maxMarketValue")).alias(
                     "skewScale_maxMarketValue_multiplier"
                 ),
             ]
@@ -0,0 +1,312 @@
+# Point-in-time queries over market summaries: resolve timestamps to blocks, serve from the local snapshot store and
+# fetch only the missing (block, market) cells from the node.
+
+import bisect
+import datetime
+import json
+import os
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import polars as pl
+
+from perpv2_market_api.market_pipe import SNXMarketData, SNXMarketPipe
+from perpv2_market_api.snapshot_store import SnapshotStore
+
+
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def _to_unix(value: int | datetime.datetime) -> int:
+    if isinstance(value, datetime.datetime):
+        return int(value.replace(tzinfo=value.tzinfo or datetime.timezone.utc).timestamp())
+    return int(value)
+
+
+def parse_interval(every: int | str | datetime.timedelta) -> int:
+    """
+    Return an interval in seconds. Accepts seconds, a `timedelta` or a string like `'30s'`, `'15m'`, `'1h'`, `'1d'`, `'1w'`.
+    """
+    match every:
+        case datetime.timedelta():
+            seconds = int(every.total_seconds())
+        case str() if every[-1:] in INTERVAL_UNITS and every[:-1].isdigit():
+            seconds = int(every[:-1]) * INTERVAL_UNITS[every[-1]]
+        case int():
+            seconds = every
+        case _:
+            raise ValueError(f"Invalid interval: {every!r}")
+
+    if seconds <= 0:
+        raise ValueError(f"Interval must be positive: {every!r}")
+    return seconds
+
+
+@dataclass
+class BlockHeaderIndex:
+    """
+    Cached block -> timestamp index used to resolve timestamps to blocks.
+
+    Resolving a timestamp searches between the closest cached headers, alternating interpolation and bisection steps,
+    so repeated or nearby lookups need few or no RPC calls. If `path` is set, headers are loaded from that JSON file
+    on creation and written back by `save()`.
+    """
+    pipe: SNXMarketPipe = field(default_factory=SNXMarketPipe)
+    path: str = None
+    _blocks: list = field(default_factory=list, repr=False)
+    _timestamps: list = field(default_factory=list, repr=False)
+
+    def __post_init__(self):
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path) as f:
+                for block, timestamp in json.load(f).items():
+                    self._add(int(block), timestamp)
+
+    def timestamp(self, block: int) -> int:
+        """
+        Return the timestamp of `block`, fetching its header on first use.
+        """
+        i = bisect.bisect_left(self._blocks, block)
+        if i < len(self._blocks) and self._blocks[i] == block:
+            return self._timestamps[i]
+
+        block, timestamp = self.pipe._get_block(block)
+        self._add(block, timestamp)
+        return timestamp
+
+    def latest(self) -> tuple[int, int]:
+        """
+        Return the latest block number and timestamp. Always fetched from the node.
+        """
+        block, timestamp = self.pipe._get_block(0)
+        self._add(block, timestamp)
+        return block, timestamp
+
+    def block_at(self, timestamp: int | datetime.datetime) -> int:
+        """
+        Return the last block with a timestamp at or before `timestamp`. Timestamps past the chain head resolve to the
+        latest block.
+
+        Raises:
+            ValueError: If `timestamp` is before the first block.
+        """
+        timestamp = _to_unix(timestamp)
+
+        # lo is a block known to be at or before the timestamp, hi a block known to be after it.
+        i = bisect.bisect_right(self._timestamps, timestamp)
+        if i == len(self._timestamps):
+            head, head_timestamp = self.latest()
+            if head_timestamp <= timestamp:
+                return head
+            i = bisect.bisect_right(self._timestamps, timestamp)
+        hi = self._blocks[i]
+
+        if i > 0:
+            lo = self._blocks[i - 1]
+        else:
+            lo = 1
+            if self.timestamp(lo) > timestamp:
+                raise ValueError(f"Timestamp {timestamp} is before the first block.")
+
+        step = 0
+        while hi - lo > 1:
+            lo_timestamp = self.timestamp(lo)
+            hi_timestamp = self.timestamp(hi)
+            if step % 2 == 0 and hi_timestamp > lo_timestamp:
+                guess = lo + (timestamp - lo_timestamp) * (hi - lo) // (hi_timestamp - lo_timestamp)
+            else:
+                guess = (lo + hi) // 2
+            guess = min(max(guess, lo + 1), hi - 1)
+
+            if self.timestamp(guess) <= timestamp:
+                lo = guess
+            else:
+                hi = guess
+            step += 1
+
+        return lo
+
+    def save(self, path: str = None):
+        """
+        Write cached headers to `path`, or to `self.path` if not given.
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path given to save block headers to.")
+        with open(path, 'w') as f:
+            json.dump(dict(zip(map(str, self._blocks), self._timestamps)), f)
+
+    def _add(self, block: int, timestamp: int):
+        i = bisect.bisect_left(self._blocks, block)
+        if i < len(self._blocks) and self._blocks[i] == block:
+            return
+        self._blocks.insert(i, block)
+        self._timestamps.insert(i, timestamp)
+
+
+@dataclass
+class SNXMarketHistory:
+    """
+    Time-travel API over SNX perps v2 market summaries.
+
+    Data is read from the local `store` when it holds the block. Missing data is fetched from the node, one batched call
+    per block, concurrently across blocks:
+    - all markets - `allMarketSummaries`, and the snapshot is appended to the store.
+    - selected markets - `marketSummariesForKeys` for only the missing markets.
+
+    Usage:
+        with SNXMarketHistory(store=SnapshotStore('data/market_summaries.snxs')) as history:
+            eth_btc = history.history(['sETHPERP', 'sBTCPERP'], start=datetime(2023, 9, 1), end=datetime(2023, 9, 2), every='1h')
+
+    - Note that appended snapshots are buffered by the store and written out on its own schedule, call `close()` (or use
+    the context manager) to write out the rest.
+    - Note that partial snapshots are not persisted, the store only holds complete blocks. The fetched cells are kept
+    in memory for the lifetime of the object, the `max_cells` most recently used ones.
+    """
+    store: SnapshotStore = None
+    headers_path: str = None
+    exact: bool = False
+    max_workers: int = 8
+    max_cells: int = 100_000
+    _cells: OrderedDict = field(default_factory=OrderedDict, repr=False)  # (block, key) -> raw market row, in LRU order
+
+    def __post_init__(self):
+        self.data = SNXMarketData()
+        self.pipe = self.data.pipe
+        self.headers = BlockHeaderIndex(self.pipe, self.headers_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Write out snapshots buffered by the store and the block header index.
+        """
+        if self.store is not None:
+            self.store.close()
+        if self.headers_path is not None:
+            self.headers.save()
+
+    def snapshot_at(self, timestamp: int | datetime.datetime, markets: list[str] = None) -> pl.DataFrame:
+        """
+        Return market summaries as of `timestamp`, i.e. at the last block at or before it.
+
+        Args:
+            timestamp (int | datetime): Unix timestamp or datetime. Naive datetimes are treated as UTC.
+            markets (list[str], optional): Market keys, e.g. `['sETHPERP']`. Defaults to all markets.
+        """
+        block = self.headers.block_at(timestamp)
+        return self.data.preprocess_market_summary_df(self._load_blocks([block], markets), self.exact)
+
+    def history(self, markets: list[str] | None, start: int | datetime.datetime, end: int | datetime.datetime,
+                every: int | str | datetime.timedelta = '1h') -> pl.DataFrame:
+        """
+        Return market summaries resampled to a regular time grid.
+
+        Args:
+            markets (list[str] | None): Market keys, e.g. `['sETHPERP']`. `None` for all markets.
+            start (int | datetime): First grid point, unix timestamp or datetime.
+            end (int | datetime): Last grid point (inclusive), unix timestamp or datetime.
+            every (int | str | timedelta): Grid interval, in seconds or a string like `'15m'`, `'1h'`, `'1d'`. (Default: '1h')
+
+        Returns:
+            pl.DataFrame: One row per grid point and market, with the grid time as `datetime` and the state as of that
+                time (`block`, `timestamp` and the `SNXMarketSummaryStruct` columns), sorted by `datetime` and `key`.
+        """
+        start, end = _to_unix(start), _to_unix(end)
+        grid = list(range(start, end + 1, parse_interval(every)))
+
+        grid_blocks = [self.headers.block_at(t) for t in grid]
+        if self.headers_path is not None:
+            self.headers.save()
+
+        df = self.data.preprocess_market_summary_df(self._load_blocks(sorted(set(grid_blocks)), markets), self.exact)
+
+        grid_df = pl.DataFrame({'datetime': grid, 'block': grid_blocks}).with_columns(
+            pl.from_epoch('datetime'),
+            pl.col('block').cast(df.schema['block']),
+        )
+
+        return grid_df.join(df, on='block', how='inner').sort('datetime', 'key')
+
+    def _load_blocks(self, blocks: list[int], markets: list[str] = None) -> list[dict]:
+        """
+        Return one raw snapshot per block, restricted to `markets`, reading the store and in-memory cells first and
+        fetching only what is missing.
+        """
+        snapshots = {}
+        missing = {}  # block -> market keys to fetch, None for all markets
+
+        for block in blocks:
+            stored = self.store.read_block(block) if self.store is not None else None
+            if stored is not None:
+                snapshots[block] = self._select(stored, markets)
+                continue
+
+            if markets is None:
+                missing[block] = None
+                continue
+
+            rows = [self._get_cell(block, key) for key in markets if (block, key) in self._cells]
+            missing_keys = [key for key in markets if (block, key) not in self._cells]
+            if rows:
+                snapshots[block] = {"block": block, "timestamp": self.headers.timestamp(block), "results": rows}
+            if missing_keys:
+                missing[block] = missing_keys
+
+        for snapshot, keys in self._fetch(missing):
+            block = snapshot['block']
+            if keys is None:
+                if self.store is not None:
+                    self.store.append(snapshot)
+                snapshots[block] = snapshot
+                continue
+
+            for row in snapshot['results']:
+                self._put_cell(block, _decode_key(row['key']), row)
+            if block in snapshots:
+                snapshots[block]['results'].extend(snapshot['results'])
+            else:
+                snapshots[block] = snapshot
+
+        return [snapshots[block] for block in blocks if block in snapshots]
+
+    def _get_cell(self, block: int, key: str) -> dict:
+        self._cells.move_to_end((block, key))
+        return self._cells[(block, key)]
+
+    def _put_cell(self, block: int, key: str, row: dict):
+        self._cells[(block, key)] = row
+        self._cells.move_to_end((block, key))
+        while len(self._cells) > self.max_cells:
+            self._cells.popitem(last=False)
+
+    def _fetch(self, missing: dict) -> list[tuple[dict, list[str]]]:
+        """Fetch missing blocks concurrently. Returns (raw snapshot, requested keys) pairs in block order."""
+        def fetch(block: int):
+            keys = missing[block]
+            if keys is None:
+                return self.pipe.get_all_market_summaries(block), keys
+            return self.pipe.get_market_summaries(keys, block), keys
+
+        if not missing:
+            return []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(fetch, sorted(missing)))
+
+    @staticmethod
+    def _select(snapshot: dict, markets: list[str] = None) -> dict:
+        if markets is None:
+            return snapshot
+        keys = set(markets)
+        return {**snapshot, "results": [row for row in snapshot['results'] if _decode_key(row['key']) in keys]}
+
+
+def _decode_key(key: bytes) -> str:
+    return key.decode("utf-8").split('\x00')[0]
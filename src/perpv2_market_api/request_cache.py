@@ -0,0 +1,200 @@
+# Helper module to share ABIs, contract objects and in-flight RPC calls between concurrent callers.
+
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Hashable
+
+
+@dataclass
+class CacheStats:
+    """
+    Counters describing how requests were served.
+
+    Attributes:
+        hits (int): Requests answered from the snapshot memo without touching the node.
+        misses (int): Requests that triggered a new RPC call.
+        coalesced (int): Requests that waited on an identical in-flight RPC call instead of making their own.
+        abi_loads (int): ABI files read from disk.
+        contract_builds (int): Contract objects constructed.
+    """
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    abi_loads: int = 0
+    contract_builds: int = 0
+
+    def to_dict(self) -> dict:
+        return {k: v for k, v in asdict(self).items()}
+
+
+@dataclass
+class ContractRegistry:
+    """
+    Process-wide registry of loaded ABIs and contract objects. Each ABI file is read once and each
+    (node, address, abi) contract is constructed once, no matter how many callers ask for it.
+    """
+    stats: CacheStats = field(default_factory=CacheStats)
+    _abis: dict = field(default_factory=dict, repr=False)
+    _contracts: dict = field(default_factory=dict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def get_abi(self, file: str) -> list[dict]:
+        """
+        Return the parsed ABI stored at `file`, reading it from disk on first use.
+        """
+        path = os.path.abspath(file)
+
+        with self._lock:
+            if path not in self._abis:
+                with open(path) as f:
+                    self._abis[path] = json.load(f)
+                self.stats.abi_loads += 1
+            return self._abis[path]
+
+    def get_contract(self, node, address: str, file: str):
+        """
+        Return the contract object for `address` on `node`, constructing it on first use.
+        """
+        abi = self.get_abi(file)
+        # the node itself is part of the key, not id(node). The registry then holds a strong reference, so an id
+        # reused after garbage collection can never hand out a contract bound to a dead provider.
+        key = (node, address, os.path.abspath(file))
+
+        with self._lock:
+            if key not in self._contracts:
+                self._contracts[key] = node.eth.contract(address=address, abi=abi)
+                self.stats.contract_builds += 1
+            return self._contracts[key]
+
+
+def copy_snapshot(value: Any) -> Any:
+    """
+    Copy of a raw snapshot dict down to its market rows, so callers sharing a memoized result cannot see each other's
+    mutations. Row values are immutable (ints, str, bytes, bool). Values that are not snapshots are returned as is.
+    """
+    if not isinstance(value, dict):
+        return value
+    results = value.get('results')
+    if isinstance(results, list):
+        return {**value, 'results': [dict(row) for row in results]}
+    if isinstance(results, dict):
+        return {**value, 'results': dict(results)}
+    return dict(value)
+
+
+@dataclass
+class SnapshotCache:
+    """
+    Single-flight layer with a memo of decoded snapshots.
+
+    Concurrent callers asking for the same key share one in-flight call. Once the call completes, the result is
+    memoized:
+    - historical blocks never change, so their results are kept in an LRU of `max_entries` with no expiry.
+    - "latest" results are kept for `ttl` seconds, so that callers arriving shortly after are served without touching
+    the node. The default TTL matches the 2 second Optimism block time, so they are never older than one block.
+    They are also stored under the resolved block, so later callers asking for that block explicitly share them.
+
+    Every caller gets its own copy of the result, made by `copy` (Default: `copy_snapshot()`).
+    """
+    ttl: float = 2.0
+    max_entries: int = 256
+    copy: Callable[[Any], Any] = field(default=copy_snapshot, repr=False)
+    stats: CacheStats = field(default_factory=CacheStats)
+    _memo: dict = field(default_factory=dict, repr=False)  # latest key -> (monotonic time, result)
+    _blocks: OrderedDict = field(default_factory=OrderedDict, repr=False)  # historical key -> result, in LRU order
+    _in_flight: dict = field(default_factory=dict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def get_or_call(self, key: Hashable, fn: Callable[[], Any], latest_key: Callable[[Any], Hashable] = None) -> Any:
+        """
+        Return the memoized result for `key`, wait on an identical in-flight call, or call `fn()` and share
+        its result with every caller that arrives while it runs. Exceptions are propagated to all waiters and
+        are not memoized.
+
+        Args:
+            key (Hashable): Key of the call.
+            fn (Callable): The call, run by the first caller only.
+            latest_key (Callable, optional): Set if `key` asks for the latest block. The result is then memoized for
+                `ttl` seconds and stored permanently under `latest_key(result)`. If not set, the result is memoized
+                permanently under `key`.
+        """
+        latest = latest_key is not None
+
+        with self._lock:
+            found, result = self._lookup(key, latest)
+            if found:
+                self.stats.hits += 1
+                return self.copy(result)
+
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+                self.stats.misses += 1
+            else:
+                self.stats.coalesced += 1
+
+        if not leader:
+            return self.copy(future.result())
+
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            if latest:
+                self._evict_expired()
+                self._memo[key] = (time.monotonic(), result)
+                self._store(latest_key(result), result)
+            else:
+                self._store(key, result)
+            del self._in_flight[key]
+        future.set_result(result)
+
+        return self.copy(result)
+
+    def clear(self):
+        """
+        Drop all memoized results. In-flight calls are left untouched.
+        """
+        with self._lock:
+            self._memo.clear()
+            self._blocks.clear()
+
+    def _lookup(self, key: Hashable, latest: bool) -> tuple[bool, Any]:
+        """Return (found, result) for `key`. Must be called with the lock held."""
+        if latest:
+            entry = self._memo.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return True, entry[1]
+            return False, None
+
+        if key in self._blocks:
+            self._blocks.move_to_end(key)
+            return True, self._blocks[key]
+        return False, None
+
+    def _store(self, key: Hashable, result: Any):
+        """Memoize a historical result, evicting the least recently used. Must be called with the lock held."""
+        self._blocks[key] = result
+        self._blocks.move_to_end(key)
+        while len(self._blocks) > self.max_entries:
+            self._blocks.popitem(last=False)
+
+    def _evict_expired(self):
+        """Drop expired memo entries. Must be called with the lock held."""
+        now = time.monotonic()
+        expired = [k for k, (t, _) in self._memo.items() if now - t >= self.ttl]
+        for k in expired:
+            del self._memo[k]
@@ -0,0 +1,543 @@
+# Storage codec for dense per-block histories of raw `allMarketSummaries` snapshots.
+#
+# A store file is a sequence of self-contained segments. Each segment holds one keyframe followed by per-block
+# deltas of only the market fields that changed. Strings and bytes (market addresses, assets, keys) are dictionary
+# encoded per segment and on-chain integers are kept as exact fixed-point values written as zigzag varints, so
+# decoded snapshots are identical to what `SNXMarketPipe.get_all_market_summaries()` returned.
+#
+# Segment layout:
+#     header  - magic, first block, last block, number of frames, payload length
+#     payload - zlib compressed: block numbers, field schema, dictionary, frames
+
+import bisect
+import heapq
+import os
+import struct
+import zlib
+
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator
+
+
+MAGIC = b'SNXS'
+SEGMENT_HEADER = struct.Struct('<4sQQII')
+
+# frame kinds
+KEYFRAME = 0
+DELTA = 1
+
+# field kinds
+INT = 0
+STR = 1
+BYTES = 2
+BOOL = 3
+
+DICTIONARY_KINDS = (STR, BYTES)
+
+
+def _field_kind(value) -> int:
+    """Return the field kind used to encode `value`."""
+    match value:
+        case bool():
+            return BOOL
+        case int():
+            return INT
+        case str():
+            return STR
+        case bytes():
+            return BYTES
+        case _:
+            raise TypeError(f"Cannot encode value of type {type(value).__name__}: {value!r}")
+
+
+def _write_varint(buf: bytearray, value: int):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _write_signed(buf: bytearray, value: int):
+    """zigzag encoding so small negative values stay small. Works for arbitrary precision ints."""
+    _write_varint(buf, value << 1 if value >= 0 else ((-value) << 1) - 1)
+
+
+@dataclass
+class _Cursor:
+    """Reads varints back from a decompressed payload."""
+    buf: bytes
+    pos: int = 0
+
+    def varint(self) -> int:
+        result = 0
+        shift = 0
+        while True:
+            b = self.buf[self.pos]
+            self.pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                return result
+            shift += 7
+
+    def signed(self) -> int:
+        z = self.varint()
+        return z >> 1 if not z & 1 else -(z >> 1) - 1
+
+    def raw(self) -> bytes:
+        n = self.varint()
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+
+def snapshot_schema(snapshot: dict) -> tuple:
+    """
+    Return the `(name, kind)` field schema of a raw snapshot, or `None` if the snapshot has no markets.
+    """
+    if not snapshot['results']:
+        return None
+    return tuple((name, _field_kind(value)) for name, value in snapshot['results'][0].items())
+
+
+def encode_segment(snapshots: list[dict], schema: tuple) -> bytes:
+    """
+    Encode raw snapshots sharing the same `schema` into an uncompressed segment payload. Snapshots must be in
+    strictly increasing block order. The first snapshot is stored as a keyframe, the rest as deltas.
+    """
+    names = [name for name, _ in schema]
+    kinds = [kind for _, kind in schema]
+    market_idx = names.index('market')
+
+    dictionary: dict = {}
+
+    def dict_id(kind: int, value) -> int:
+        return dictionary.setdefault((kind, value), len(dictionary))
+
+    def write_value(buf: bytearray, kind: int, value):
+        match kind:
+            case 0:  # INT
+                _write_signed(buf, value)
+            case 3:  # BOOL
+                buf.append(1 if value else 0)
+            case _:
+                _write_varint(buf, dict_id(kind, value))
+
+    def write_row(buf: bytearray, row: tuple):
+        for kind, value in zip(kinds, row):
+            write_value(buf, kind, value)
+
+    frames = bytearray()
+    state: dict = {}
+    previous_timestamp = snapshots[0]['timestamp']
+
+    for i, snapshot in enumerate(snapshots):
+        rows = {}
+        for market in snapshot['results']:
+            row = tuple(market[name] for name in names)
+            if row[market_idx] in rows:
+                raise ValueError(f"Market {row[market_idx]} appears twice in block {snapshot['block']}.")
+            rows[row[market_idx]] = row
+
+        removed = [m for m in state if m not in rows]
+        added = [m for m in rows if m not in state]
+        expected_order = [m for m in state if m in rows] + added
+
+        _write_signed(frames, snapshot['timestamp'] - previous_timestamp)
+        previous_timestamp = snapshot['timestamp']
+
+        # markets that were reordered cannot be described by a delta, fall back to a keyframe
+        if i == 0 or expected_order != list(rows):
+            frames.append(KEYFRAME)
+            _write_varint(frames, len(rows))
+            for row in rows.values():
+                write_row(frames, row)
+            state = rows
+            continue
+
+        frames.append(DELTA)
+        _write_varint(frames, len(removed))
+        for market in removed:
+            _write_varint(frames, dict_id(kinds[market_idx], market))
+
+        _write_varint(frames, len(added))
+        for market in added:
+            write_row(frames, rows[market])
+
+        changed = []
+        for market, row in rows.items():
+            if market in added:
+                continue
+            previous = state[market]
+            mask = 0
+            for j, (old, new) in enumerate(zip(previous, row)):
+                if old != new:
+                    mask |= 1 << j
+            if mask:
+                changed.append((market, mask, previous, row))
+
+        _write_varint(frames, len(changed))
+        for market, mask, previous, row in changed:
+            _write_varint(frames, dict_id(kinds[market_idx], market))
+            _write_varint(frames, mask)
+            for j, kind in enumerate(kinds):
+                if mask >> j & 1:
+                    if kind == INT:
+                        _write_signed(frames, row[j] - previous[j])
+                    else:
+                        write_value(frames, kind, row[j])
+
+        state = rows
+
+    payload = bytearray()
+
+    # block numbers
+    _write_varint(payload, len(snapshots))
+    previous_block = snapshots[0]['block']
+    _write_varint(payload, previous_block)
+    for snapshot in snapshots[1:]:
+        _write_varint(payload, snapshot['block'] - previous_block)
+        previous_block = snapshot['block']
+
+    # schema
+    _write_varint(payload, len(schema))
+    for name, kind in schema:
+        encoded = name.encode('utf-8')
+        _write_varint(payload, len(encoded))
+        payload += encoded
+        payload.append(kind)
+
+    # dictionary
+    _write_varint(payload, len(dictionary))
+    for kind, value in dictionary:
+        encoded = value.encode('utf-8') if kind == STR else value
+        payload.append(kind)
+        _write_varint(payload, len(encoded))
+        payload += encoded
+
+    _write_signed(payload, snapshots[0]['timestamp'])
+    payload += frames
+
+    return bytes(payload)
+
+
+def _decode_blocks(cursor: _Cursor) -> list[int]:
+    n = cursor.varint()
+    blocks = [cursor.varint()]
+    for _ in range(n - 1):
+        blocks.append(blocks[-1] + cursor.varint())
+    return blocks
+
+
+def decode_segment_blocks(payload: bytes) -> list[int]:
+    """
+    Return the block numbers stored in an uncompressed segment payload without replaying its frames.
+    """
+    return _decode_blocks(_Cursor(payload))
+
+
+def decode_segment(payload: bytes, until_block: int = None) -> list[dict]:
+    """
+    Replay an uncompressed segment payload back into raw snapshots. If `until_block` is set, decoding stops
+    after that block.
+    """
+    cursor = _Cursor(payload)
+    blocks = _decode_blocks(cursor)
+
+    names = []
+    kinds = []
+    for _ in range(cursor.varint()):
+        names.append(cursor.raw().decode('utf-8'))
+        kinds.append(cursor.buf[cursor.pos])
+        cursor.pos += 1
+    market_idx = names.index('market')
+
+    dictionary = []
+    for _ in range(cursor.varint()):
+        kind = cursor.buf[cursor.pos]
+        cursor.pos += 1
+        value = cursor.raw()
+        dictionary.append(value.decode('utf-8') if kind == STR else bytes(value))
+
+    def read_value(kind: int):
+        match kind:
+            case 0:  # INT
+                return cursor.signed()
+            case 3:  # BOOL
+                value = cursor.buf[cursor.pos] == 1
+                cursor.pos += 1
+                return value
+            case _:
+                return dictionary[cursor.varint()]
+
+    def read_row() -> list:
+        return [read_value(kind) for kind in kinds]
+
+    snapshots = []
+    state: dict = {}
+    timestamp = cursor.signed()
+
+    for block in blocks:
+        timestamp += cursor.signed()
+        frame_kind = cursor.buf[cursor.pos]
+        cursor.pos += 1
+
+        if frame_kind == KEYFRAME:
+            state = {}
+            for _ in range(cursor.varint()):
+                row = read_row()
+                state[row[market_idx]] = row
+        else:
+            state = {market: list(row) for market, row in state.items()}
+            for _ in range(cursor.varint()):
+                del state[dictionary[cursor.varint()]]
+            for _ in range(cursor.varint()):
+                row = read_row()
+                state[row[market_idx]] = row
+            for _ in range(cursor.varint()):
+                row = state[dictionary[cursor.varint()]]
+                mask = cursor.varint()
+                for j, kind in enumerate(kinds):
+                    if mask >> j & 1:
+                        row[j] = row[j] + cursor.signed() if kind == INT else read_value(kind)
+
+        snapshots.append({
+            "block": block,
+            "timestamp": timestamp,
+            "results": [dict(zip(names, row)) for row in state.values()]
+        })
+
+        if until_block is not None and block >= until_block:
+            break
+
+    return snapshots
+
+
+def _copy_snapshot(snapshot: dict) -> dict:
+    """Copy a snapshot down to its market rows. Row values are immutable (ints, str, bytes, bool)."""
+    return {**snapshot, "results": [dict(market) for market in snapshot['results']]}
+
+
+@dataclass
+class _Segment:
+    first_block: int
+    last_block: int
+    n_frames: int
+    offset: int
+    length: int
+
+
+@dataclass
+class SnapshotStore:
+    """
+    Append-only file of raw `allMarketSummaries` snapshots, as returned by `SNXMarketPipe.get_all_market_summaries()`.
+
+    Snapshots are buffered in memory, sorted by block, and written out as one segment every `keyframe_interval`
+    blocks, on `flush()` or when the store is closed. A segment also ends early when the market field schema changes.
+    Blocks can be appended in any order, segments written at different times may then overlap and reads merge them
+    by block. Reading a block decompresses the single segment that holds it and replays deltas from its keyframe.
+
+    Usage:
+        with SnapshotStore('data/market_summaries.snxs') as store:
+            store.append(pipe.get_all_market_summaries(block))
+
+        snapshot = SnapshotStore('data/market_summaries.snxs').read_block(block)
+    """
+    path: str
+    keyframe_interval: int = 300
+    compression_level: int = 6
+    _pending: list = field(default_factory=list, repr=False)
+    _schema: tuple = field(default=None, repr=False)
+    _segments: list = field(default=None, repr=False)  # sorted by first_block
+    _first_blocks: list = field(default=None, repr=False)
+    _max_last_block: list = field(default=None, repr=False)
+    _decoded: tuple = field(default=(None, None), repr=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, snapshot: dict):
+        """
+        Append a raw snapshot. The snapshot is written to disk once its segment is complete. A buffered snapshot
+        of the same block is replaced.
+        """
+        schema = snapshot_schema(snapshot) or self._schema
+
+        if self._pending and schema != self._schema:
+            self.flush()
+
+        self._schema = schema
+        block = snapshot['block']
+        i = bisect.bisect_left(self._pending, block, key=lambda s: s['block'])
+        if i < len(self._pending) and self._pending[i]['block'] == block:
+            self._pending[i] = _copy_snapshot(snapshot)
+        else:
+            self._pending.insert(i, _copy_snapshot(snapshot))
+
+        if len(self._pending) >= self.keyframe_interval:
+            self.flush()
+
+    def extend(self, snapshots: Iterable[dict]):
+        for snapshot in snapshots:
+            self.append(snapshot)
+
+    def flush(self):
+        """
+        Write buffered snapshots to disk as a new segment.
+        """
+        if not self._pending:
+            return
+
+        if self._schema is None:
+            # nothing but empty snapshots, there is no market field to key the rows on.
+            self._schema = (('market', STR),)
+
+        payload = zlib.compress(encode_segment(self._pending, self._schema), self.compression_level)
+        header = SEGMENT_HEADER.pack(
+            MAGIC, self._pending[0]['block'], self._pending[-1]['block'], len(self._pending), len(payload)
+        )
+
+        with open(self.path, 'ab') as f:
+            offset = f.tell() + SEGMENT_HEADER.size
+            f.write(header)
+            f.write(payload)
+
+        segment = _Segment(self._pending[0]['block'], self._pending[-1]['block'], len(self._pending), offset, len(payload))
+        self._pending = []
+        if self._segments is not None:
+            self._insert_segment(segment)
+
+    def close(self):
+        self.flush()
+
+    def blocks(self) -> list[int]:
+        """
+        Return the sorted list of all stored block numbers, including buffered ones.
+        """
+        blocks = set(snapshot['block'] for snapshot in self._pending)
+        for segment in self._index():
+            blocks.update(decode_segment_blocks(self._read_payload(segment)))
+        return sorted(blocks)
+
+    def read_block(self, block: int) -> dict:
+        """
+        Reconstruct the raw snapshot stored for `block`. Returns `None` if the block is not in the store.
+
+        The returned snapshot is a copy and can be mutated freely.
+        """
+        i = bisect.bisect_left(self._pending, block, key=lambda s: s['block'])
+        if i < len(self._pending) and self._pending[i]['block'] == block:
+            return _copy_snapshot(self._pending[i])
+
+        segments = self._index()
+        i = bisect.bisect_right(self._first_blocks, block) - 1
+
+        while i >= 0 and self._max_last_block[i] >= block:
+            segment = segments[i]
+            if segment.last_block >= block:
+                for snapshot in self._decode(segment, until_block=block):
+                    if snapshot['block'] == block:
+                        return _copy_snapshot(snapshot)
+            i -= 1
+
+        return None
+
+    def iter_snapshots(self, start: int = None, end: int = None) -> Iterator[dict]:
+        """
+        Yield stored snapshots with `start <= block <= end`, including buffered ones, in block order. Overlapping
+        segments are merged, a segment is only decoded once the merge reaches its first block.
+
+        Yielded snapshots are copies and can be mutated freely.
+        """
+        start = 0 if start is None else start
+        end = float('inf') if end is None else end
+
+        segments = [s for s in self._index() if s.last_block >= start and s.first_block <= end]
+        heap = []  # (block, source, position, snapshots)
+
+        def push(source: int, position: int, snapshots: list[dict]):
+            while position < len(snapshots) and snapshots[position]['block'] < start:
+                position += 1
+            if position < len(snapshots):
+                heapq.heappush(heap, (snapshots[position]['block'], source, position, snapshots))
+
+        # buffered snapshots go first, so they win over a stored copy of the same block
+        push(-1, 0, list(self._pending))
+
+        i = 0
+        last_block = None
+        while True:
+            while i < len(segments) and (not heap or segments[i].first_block <= heap[0][0]):
+                push(i, 0, self._decode(segments[i]))
+                i += 1
+            if not heap:
+                return
+
+            block, source, position, snapshots = heapq.heappop(heap)
+            if block > end:
+                return
+            if block != last_block:
+                last_block = block
+                yield _copy_snapshot(snapshots[position])
+            push(source, position + 1, snapshots)
+
+    def _index(self) -> list[_Segment]:
+        """Scan segment headers once to build the in-memory segment index."""
+        if self._segments is not None:
+            return self._segments
+
+        segments = []
+
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                while True:
+                    header = f.read(SEGMENT_HEADER.size)
+                    if len(header) < SEGMENT_HEADER.size:
+                        break
+                    magic, first_block, last_block, n_frames, length = SEGMENT_HEADER.unpack(header)
+                    if magic != MAGIC:
+                        raise ValueError(f"{self.path} is not a snapshot store or is corrupted at offset {f.tell()}")
+                    segments.append(_Segment(first_block, last_block, n_frames, f.tell(), length))
+                    f.seek(length, os.SEEK_CUR)
+
+        self._segments = sorted(segments, key=lambda s: s.first_block)
+        self._first_blocks = [s.first_block for s in self._segments]
+        self._max_last_block = []
+        self._update_max_last_block(0)
+
+        return self._segments
+
+    def _insert_segment(self, segment: _Segment):
+        i = bisect.bisect_right(self._first_blocks, segment.first_block)
+        self._segments.insert(i, segment)
+        self._first_blocks.insert(i, segment.first_block)
+        self._update_max_last_block(i)
+
+    def _update_max_last_block(self, i: int):
+        """
+        Recompute the running max of `last_block` from segment `i` on. It lets read_block() stop scanning once no
+        earlier segment can hold the block. Segments appended at the end, the usual case, cost O(1).
+        """
+        del self._max_last_block[i:]
+        running = self._max_last_block[-1] if self._max_last_block else -1
+        for segment in self._segments[i:]:
+            running = max(running, segment.last_block)
+            self._max_last_block.append(running)
+
+    def _read_payload(self, segment: _Segment) -> bytes:
+        with open(self.path, 'rb') as f:
+            f.seek(segment.offset)
+            return zlib.decompress(f.read(segment.length))
+
+    def _decode(self, segment: _Segment, until_block: int = None) -> list[dict]:
+        """Decode a segment, reusing the last fully decoded segment for sequential reads."""
+        offset, snapshots = self._decoded
+        if offset == segment.offset:
+            return snapshots
+
+        snapshots = decode_segment(self._read_payload(segment), until_block)
+        if until_block is None or len(snapshots) == segment.n_frames:
+            self._decoded = (segment.offset, snapshots)
+        return snapshots
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+
+def _bytes32(value: str) -> bytes:
+    return value.encode('utf-8').ljust(32, b'\x00')
+
+
+def make_history(n_blocks: int = 50, n_markets: int = 5, seed: int = 0, first_block: int = 100_000_000,
+                 first_timestamp: int = 1_700_000_000, block_times=(2,)) -> list[dict]:
+    """
+    Synthetic raw `allMarketSummaries` snapshots, in the format returned by `SNXMarketPipe.get_all_market_summaries()`.
+    Each block, a random subset of markets trades: price, skew, size and funding move, everything else stays the same.
+    """
+    rnd = random.Random(seed)
+    markets = []
+    for i in range(n_markets):
+        markets.append({
+            'market': '0x%040x' % rnd.getrandbits(160),
+            'asset': _bytes32(f's{i}'),
+            'key': _bytes32(f's{i}PERP'),
+            'maxLeverage': 25 * 10**18,
+            'price': rnd.randint(1, 5000) * 10**18 + rnd.getrandbits(50),
+            'marketSize': rnd.getrandbits(80),
+            'marketSkew': rnd.getrandbits(70) - 2**69,
+            'marketDebt': rnd.getrandbits(90),
+            'currentFundingRate': rnd.getrandbits(55) - 2**54,
+            'currentFundingVelocity': rnd.getrandbits(50),
+            'takerFee': 10**15,
+            'makerFee': 2 * 10**14,
+            'takerFeeDelayedOrder': 10**15,
+            'makerFeeDelayedOrder': 10**15,
+            'takerFeeOffchainDelayedOrder': 6 * 10**14,
+            'makerFeeOffchainDelayedOrder': 2 * 10**14,
+        })
+
+    history = []
+    timestamp = first_timestamp
+    for block in range(first_block, first_block + n_blocks):
+        timestamp += rnd.choice(block_times)
+        for market in markets:
+            if rnd.random() < 0.3:
+                market['price'] += rnd.randint(-10**16, 10**16)
+            if rnd.random() < 0.1:
+                trade = rnd.randint(-10**19, 10**19)
+                market['marketSkew'] += trade
+                market['marketSize'] += abs(trade)
+            if rnd.random() < 0.3:
+                market['currentFundingRate'] += rnd.randint(-10**10, 10**10)
+        history.append({'block': block, 'timestamp': timestamp, 'results': [dict(m) for m in markets]})
+
+    return history
+
+
+@pytest.fixture
+def history_factory():
+    return make_history
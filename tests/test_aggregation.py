@@ -0,0 +1,92 @@
+from decimal import Decimal
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from perpv2_market_api.aggregation import ProtocolAggregates, aggregate_blocks
+from perpv2_market_api.market_pipe import SNXMarketData
+
+
+@pytest.fixture
+def summaries(history_factory):
+    return SNXMarketData().preprocess_market_summary_df(history_factory(n_blocks=60))
+
+
+def _blocks(df: pl.DataFrame, first: int, last: int) -> pl.DataFrame:
+    blocks = df['block'].unique().sort()
+    return df.filter(pl.col('block').is_between(blocks[first], blocks[last]))
+
+
+def test_metrics_match_hand_computed_values():
+    df = pl.DataFrame({
+        'block': [1, 1, 1, 2, 2],
+        'timestamp': [10, 10, 10, 12, 12],
+        'marketSize_usd': [100.0, 300.0, 600.0, 50.0, 50.0],
+        'marketSkew_usd': [50.0, -150.0, 0.0, 0.0, 0.0],
+        'marketDebt_usd': [10.0, -30.0, 60.0, 1.0, 1.0],
+        'long_oi_usd': [75.0, 75.0, 300.0, 25.0, 25.0],
+        'short_oi_usd': [25.0, 225.0, 300.0, 25.0, 25.0],
+        'relative_market_skew': [0.5, -0.5, 0.0, 0.0, 0.0],
+    })
+
+    result = aggregate_blocks(df).to_dicts()
+
+    assert result[0] == {
+        'block': 1, 'timestamp': 10, 'n_markets': 3,
+        'total_marketSize_usd': 1000.0, 'total_long_oi_usd': 450.0, 'total_short_oi_usd': 550.0,
+        'total_marketDebt_usd': 40.0, 'net_marketSkew_usd': -100.0, 'gross_marketSkew_usd': 200.0,
+        'net_skew_ratio': -0.5,
+        'oi_hhi': pytest.approx((100**2 + 300**2 + 600**2) / 1000**2),
+        'skew_hhi': pytest.approx((50**2 + 150**2) / 200**2),
+        'debt_weighted_skew': pytest.approx((10 * 0.5 + 30 * -0.5) / 100),
+    }
+    # no skew at all: ratios are null, not NaN
+    assert result[1]['net_skew_ratio'] is None and result[1]['skew_hhi'] is None
+    assert result[1]['oi_hhi'] == 0.5
+
+
+def test_hhi_bounds_and_exact_totals(summaries):
+    result = aggregate_blocks(summaries)
+
+    assert result.schema['net_marketSkew_usd'] == summaries.schema['marketSkew_usd']
+    assert result['net_marketSkew_usd'][0] == sum(summaries.filter(pl.col('block') == result['block'][0])['marketSkew_usd'], Decimal(0))
+    assert ((result['oi_hhi'] >= 1 / result['n_markets']) & (result['oi_hhi'] <= 1)).all()
+    assert ((result['skew_hhi'] >= 1 / result['n_markets'] - 1e-12) & (result['skew_hhi'] <= 1)).all()
+    assert (result['net_skew_ratio'].abs() <= 1).all()
+
+
+def test_appends_match_single_pass(summaries):
+    aggregates = ProtocolAggregates(max_chunks=4)
+    for first, last in [(0, 9), (10, 10), (11, 29), (40, 59), (30, 39)]:  # in order, then an older range
+        aggregates.append(_blocks(summaries, first, last))
+
+    assert_frame_equal(aggregates.table, aggregate_blocks(summaries))
+    assert aggregates.last_block == summaries['block'].max()
+    assert aggregates.table.n_chunks() < 4
+
+
+def test_append_replaces_existing_blocks(summaries):
+    aggregates = ProtocolAggregates()
+    aggregates.append(summaries)
+
+    changed = _blocks(summaries, 20, 21).filter(pl.col('market') != summaries['market'][0])
+    aggregates.append(changed)
+
+    expected = pl.concat([summaries.filter(~pl.col('block').is_in(changed['block'].unique().implode())), changed])
+    assert_frame_equal(aggregates.table, aggregate_blocks(expected))
+    assert aggregates.query(*changed['block'].unique().sort())['n_markets'].to_list() == [4, 4]
+
+
+def test_empty_append_keeps_table(summaries, tmp_path):
+    aggregates = ProtocolAggregates(str(tmp_path / 'aggregates.parquet'))
+    assert aggregates.append(summaries.clear()).is_empty()
+    assert aggregates.table is None and aggregates.last_block is None
+
+    aggregates.append(summaries)
+    table = aggregates.table
+    aggregates.append(summaries.clear())
+    assert aggregates.table is table
+
+    aggregates.save()
+    assert_frame_equal(ProtocolAggregates(aggregates.path).table, table)
@@ -0,0 +1,68 @@
+import random
+import statistics
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from perpv2_market_api.analytics import RollingAnalytics, metric_columns, rolling_metrics
+from perpv2_market_api.market_pipe import SNXMarketData
+
+
+def _summaries(history: list[dict]) -> list[list[dict]]:
+    snx_data = SNXMarketData()
+    return [[m.to_dict() for m in snx_data.preprocess_market_summary_snapshot(s)] for s in history]
+
+
+def _batch_and_online(blocks: list[list[dict]], windows: dict, checkpoints: int) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """Both paths' metrics ordered by market, then sample order. Batch input is grouped by market, so it must be re-sorted."""
+    rows = pl.from_dicts([m for block in blocks for m in block]).sort('market', maintain_order=True)
+    batch = rolling_metrics(rows, windows, checkpoints).sort('market', maintain_order=True)
+    analytics = RollingAnalytics(windows, checkpoints)
+    online = pl.from_dicts([r for block in blocks for r in analytics.update(block)], schema=batch.select(
+        ['market', 'timestamp'] + metric_columns(windows)).schema).sort('market', maintain_order=True)
+    return batch.select(online.columns), online
+
+
+@pytest.mark.parametrize('block_times, windows, checkpoints', [
+    ((2,), {'1m': 60, '10m': 600}, 6),                # several epochs of both systems
+    ((2, 60, 600, 2000), None, 60),                   # sampling gaps, default windows over ~2 weeks
+    ((0, 2), {'1m': 60, '10m': 600}, 6),              # blocks sharing a timestamp
+])
+def test_batch_matches_online(history_factory, block_times, windows, checkpoints):
+    history = history_factory(n_blocks=3000, n_markets=4, block_times=block_times)
+    windows = windows or RollingAnalytics().windows
+
+    batch, online = _batch_and_online(_summaries(history), windows, checkpoints)
+
+    assert_frame_equal(batch, online, check_exact=True)
+    assert batch[metric_columns(windows)].null_count().sum_horizontal()[0] < batch.height * len(windows)
+
+
+def test_online_memory_is_bounded(history_factory):
+    analytics = RollingAnalytics({'10m': 600}, checkpoints=10)
+    for block in _summaries(history_factory(n_blocks=2000, n_markets=2)):
+        analytics.update(block)
+
+    for state in analytics._markets.values():
+        assert len(state.checkpoints['10m']) <= 12
+
+
+def test_skew_zscore_on_long_history():
+    """Skew of 200000 +- 1 over 200k samples, the z-score must match a direct computation over the window."""
+    rnd = random.Random(0)
+    n, window, resolution = 200_000, 3600, 60
+    timestamps = [1_700_000_000 + 2 * i for i in range(n)]
+    skews = [200_000 + rnd.uniform(-1, 1) for _ in range(n)]
+    df = pl.DataFrame({
+        'market': ['m'] * n, 'timestamp': timestamps, 'price': 1.0, 'marketSkew': skews,
+        'currentFundingRate': 0.0, 'yearlyFundingRate': 0.0, 'long_oi_usd': 0.0, 'short_oi_usd': 0.0,
+    })
+
+    batch = rolling_metrics(df, {'1h': window}, checkpoints=window // resolution)['skew_zscore_1h']
+
+    for i in range(n - 5000, n, 499):
+        edge = (timestamps[i] - window) // resolution * resolution
+        samples = [x for t, x in zip(timestamps[:i + 1], skews[:i + 1]) if t > edge]
+        expected = (skews[i] - statistics.fmean(samples)) / statistics.stdev(samples)
+        assert batch[i] == pytest.approx(expected, rel=1e-6, abs=1e-9)
@@ -0,0 +1,85 @@
+from decimal import Decimal
+
+import polars as pl
+import pytest
+
+from perpv2_market_api.data_structs import SNXMarketSummaryStruct
+from perpv2_market_api.fixed_point import FIXED_POINT
+from perpv2_market_api.market_pipe import SNXMarketData, SNXMarketPipe, MARKET_DETAILS_FIXED_POINT_FIELDS
+
+
+@pytest.fixture
+def snx_data():
+    return SNXMarketData()
+
+
+@pytest.fixture
+def market_params(monkeypatch, history_factory):
+    """Exact params frame for the markets of `history_factory()`, with skewScale=1e6 and maxMarketValue=2e4."""
+    markets = history_factory(n_blocks=1)[0]['results']
+    details = {
+        m['market']: {
+            'market': m['market'], 'baseAsset': m['asset'], 'marketKey': m['key'],
+            **{c: 10**15 for c in MARKET_DETAILS_FIXED_POINT_FIELDS},
+            'skewScale': 10**6 * 10**18, 'maxMarketValue': 2 * 10**4 * 10**18, 'invalid': False,
+        }
+        for m in markets
+    }
+    monkeypatch.setattr(SNXMarketPipe, 'load_proxy_perp_addresses', lambda self: [type('D', (), {'address': a}) for a in details])
+    monkeypatch.setattr(SNXMarketPipe, 'get_market_details', lambda self, market, block=0: {'results': details[market]})
+    return SNXMarketPipe().market_param_df()
+
+
+def test_exact_summaries_keep_every_digit(snx_data, history_factory):
+    history = history_factory(n_blocks=2)
+    history[0]['results'][0]['marketDebt'] = 123456789012345678901234567  # > 2**64
+
+    df = snx_data.preprocess_market_summary_df(history)
+
+    assert df.schema['marketDebt'] == FIXED_POINT
+    assert df['marketDebt'][0] == Decimal('123456789.012345678901234567')
+    assert df.columns == list(SNXMarketSummaryStruct.__dataclass_fields__)
+
+
+def test_float_summaries_match_structs(snx_data, history_factory):
+    history = history_factory(n_blocks=3)
+    history[0]['results'][0]['marketSize'] = 0
+
+    df = snx_data.preprocess_market_summary_df(history, exact=False)
+    expected = pl.from_dicts([m.to_dict() for s in history for m in snx_data.preprocess_market_summary_snapshot(s)])
+
+    for column in expected.columns:
+        if expected.schema[column] == pl.Float64:
+            assert ((df[column] - expected[column]).abs() <= expected[column].abs() * 1e-15).all(), column
+
+
+@pytest.mark.parametrize('history', [[], [{'block': 1, 'timestamp': 2, 'results': []}]])
+def test_empty_summaries(snx_data, history):
+    df = snx_data.preprocess_market_summary_df(history)
+
+    assert df.is_empty()
+    assert df.columns == list(SNXMarketSummaryStruct.__dataclass_fields__)
+
+
+def test_exact_transform(snx_data, history_factory, market_params):
+    summaries = snx_data.preprocess_market_summary_df(history_factory(n_blocks=2))
+    df = summaries.join(market_params.select(pl.col('marketKey').alias('key'), 'skewScale', 'maxMarketValue'), on='key')
+
+    result = snx_data.transform_df(df, exact=True)
+
+    assert result.schema['executionPrice'] == FIXED_POINT
+    assert (result['skewScale_maxMarketValue_multiplier'] == Decimal(50)).all()
+
+
+@pytest.mark.parametrize('skew_scale, max_market_value', [
+    (pl.lit(1e6), pl.lit(2e4)),  # floats
+    (pl.lit(10**24, pl.Int128), pl.lit(2 * 10**22, pl.Int128)),  # raw on-chain integers
+])
+def test_exact_transform_rejects_non_decimal_params(snx_data, history_factory, skew_scale, max_market_value):
+    df = snx_data.preprocess_market_summary_df(history_factory(n_blocks=1)).with_columns(
+        skew_scale.alias('skewScale'),
+        max_market_value.alias('maxMarketValue'),
+    )
+
+    with pytest.raises(TypeError, match='skewScale'):
+        snx_data.transform_df(df, exact=True)
@@ -0,0 +1,151 @@
+import bisect
+
+import polars as pl
+import pytest
+
+from perpv2_market_api.market_pipe import SNXMarketPipe
+from perpv2_market_api.point_in_time import BlockHeaderIndex, SNXMarketHistory, _decode_key, parse_interval
+from perpv2_market_api.request_cache import SnapshotCache
+from perpv2_market_api.snapshot_store import SnapshotStore
+
+
+class FakeChain:
+    """Serves headers and market summaries of a synthetic history and records every node call."""
+
+    def __init__(self, history: list[dict]):
+        self.snapshots = {s['block']: s for s in history}
+        self.blocks = [s['block'] for s in history]
+        self.timestamps = [s['timestamp'] for s in history]
+        self.header_calls = []
+        self.all_calls = []
+        self.key_calls = []
+
+    def block_at(self, timestamp: int) -> int:
+        """Brute force reference: the last block at or before `timestamp`."""
+        return self.blocks[bisect.bisect_right(self.timestamps, timestamp) - 1]
+
+    def patch(self, monkeypatch):
+        chain = self
+
+        def _get_block(self, block_num=0):
+            chain.header_calls.append(block_num)
+            block = block_num or chain.blocks[-1]
+            return block, chain.snapshots[block]['timestamp']
+
+        def _get_all_market_summaries(self, block=0):
+            chain.all_calls.append(block)
+            return chain.snapshots[block or chain.blocks[-1]]
+
+        def _get_market_summaries(self, market_keys, block=0):
+            chain.key_calls.append((block, sorted(market_keys)))
+            snapshot = chain.snapshots[block or chain.blocks[-1]]
+            rows = [row for row in snapshot['results'] if _decode_key(row['key']) in market_keys]
+            return {**snapshot, 'results': rows}
+
+        monkeypatch.setattr(SNXMarketPipe, 'snapshot_cache', SnapshotCache())
+        monkeypatch.setattr(SNXMarketPipe, '_get_block', _get_block)
+        monkeypatch.setattr(SNXMarketPipe, '_get_all_market_summaries', _get_all_market_summaries)
+        monkeypatch.setattr(SNXMarketPipe, '_get_market_summaries', _get_market_summaries)
+
+
+@pytest.fixture
+def chain(monkeypatch, history_factory):
+    # 0 second block times give runs of blocks sharing a timestamp, like pre-Bedrock Optimism
+    chain = FakeChain(history_factory(n_blocks=3000, n_markets=3, first_block=1, block_times=(0, 2, 2, 15)))
+    chain.patch(monkeypatch)
+    return chain
+
+
+def test_parse_interval():
+    assert [parse_interval(e) for e in [30, '15m', '1h', '2d', '1w']] == [30, 900, 3600, 2 * 86400, 7 * 86400]
+    for invalid in ['1y', 'h', 0, '-1h']:
+        with pytest.raises(ValueError):
+            parse_interval(invalid)
+
+
+def test_block_at_matches_brute_force(chain):
+    headers = BlockHeaderIndex()
+    first, head = chain.timestamps[0], chain.timestamps[-1]
+
+    timestamps = list(range(first, head + 1, 97)) + chain.timestamps[::251] + [head]
+    for timestamp in timestamps:
+        assert headers.block_at(timestamp) == chain.block_at(timestamp), timestamp
+
+    assert headers.block_at(head + 3600) == chain.blocks[-1]  # past the head
+    with pytest.raises(ValueError):
+        headers.block_at(first - 1)
+
+    # cached headers and interpolation keep lookups well under a bisection over the whole chain (~12 headers each)
+    assert len(chain.header_calls) < 6 * len(timestamps)
+
+
+def test_block_at_reuses_saved_headers(chain, tmp_path):
+    path = str(tmp_path / 'headers.json')
+    timestamp = chain.timestamps[1234] + 1
+
+    headers = BlockHeaderIndex(path=path)
+    block = headers.block_at(timestamp)
+    headers.save()
+
+    calls = len(chain.header_calls)
+    assert BlockHeaderIndex(path=path).block_at(timestamp) == block
+    assert len(chain.header_calls) == calls
+
+
+def test_history_grid_and_partial_fetches(chain):
+    start, end, every = chain.timestamps[100], chain.timestamps[2500], 600
+    grid = list(range(start, end + 1, every))
+    history = SNXMarketHistory()
+
+    df = history.history(['s0PERP', 's1PERP'], start, end, every)
+
+    assert df['block'].to_list() == [chain.block_at(t) for t in grid for _ in range(2)]
+    assert df['key'].to_list() == ['s0PERP', 's1PERP'] * len(grid)
+    row = df.row(7, named=True)
+    raw = next(m for m in chain.snapshots[row['block']]['results'] if _decode_key(m['key']) == row['key'])
+    assert row['price'] == pytest.approx(raw['price'] / 10**18)
+    assert row['timestamp'] == chain.snapshots[row['block']]['timestamp']
+
+    blocks = sorted(set(df['block']))
+    assert sorted(chain.key_calls) == [(block, ['s0PERP', 's1PERP']) for block in blocks]
+
+    # only the (block, market) cells not fetched yet
+    chain.key_calls.clear()
+    df = history.history(['s1PERP', 's2PERP'], start, end, every)
+    assert sorted(chain.key_calls) == [(block, ['s2PERP']) for block in blocks]
+    assert df['key'].to_list() == ['s1PERP', 's2PERP'] * len(grid)
+
+    chain.key_calls.clear()
+    history.history(['s0PERP', 's2PERP'], start, end, every)
+    assert chain.key_calls == [] and chain.all_calls == []
+
+
+def test_store_is_filled_and_read_back(chain, tmp_path):
+    path = str(tmp_path / 'market_summaries.snxs')
+    start, end = chain.timestamps[10], chain.timestamps[200]
+
+    with SNXMarketHistory(store=SnapshotStore(path)) as history:
+        expected = history.history(None, start, end, '5m')
+        assert history.snapshot_at(end)['block'].unique().to_list() == [chain.block_at(end)]
+    fetched = list(chain.all_calls)
+
+    with SNXMarketHistory(store=SnapshotStore(path)) as history:
+        assert history.history(None, start, end, '5m').equals(expected)
+        subset = history.history(['s2PERP'], start, end, '5m')
+
+    assert chain.all_calls == fetched and chain.key_calls == []
+    assert subset.equals(expected.filter(pl.col('key') == 's2PERP'))
+    assert SnapshotStore(path).blocks() == sorted(set(fetched))
+
+
+def test_cells_are_bounded(chain):
+    history = SNXMarketHistory(max_cells=4)
+    block = chain.blocks[500]
+
+    history.snapshot_at(chain.snapshots[block]['timestamp'], ['s0PERP', 's1PERP'])
+    history.snapshot_at(chain.snapshots[block + 10]['timestamp'], ['s0PERP', 's1PERP', 's2PERP'])
+    assert len(history._cells) == 4
+
+    chain.key_calls.clear()
+    history.snapshot_at(chain.snapshots[block]['timestamp'], ['s0PERP', 's1PERP'])
+    assert len(chain.key_calls) == 1  # evicted cells are fetched again
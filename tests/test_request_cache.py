@@ -0,0 +1,159 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from perpv2_market_api.market_pipe import SNXMarketPipe
+from perpv2_market_api.request_cache import ContractRegistry, SnapshotCache
+
+
+def _wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def _run_concurrently(cache: SnapshotCache, fn, n: int, release: threading.Event) -> list:
+    """Call `cache.get_or_call('key', fn)` from `n` threads, releasing `fn` once all of them are waiting."""
+    results = [None] * n
+
+    def call(i):
+        try:
+            results[i] = cache.get_or_call('key', fn)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: cache.stats.misses + cache.stats.coalesced == n)
+    release.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_threads_share_one_call():
+    cache, release, calls = SnapshotCache(), threading.Event(), []
+
+    def fn():
+        calls.append(1)
+        release.wait()
+        return {'block': 1, 'results': [{'price': 1}]}
+
+    results = _run_concurrently(cache, fn, 8, release)
+
+    assert len(calls) == 1
+    assert all(r == {'block': 1, 'results': [{'price': 1}]} for r in results)
+    assert len({id(r) for r in results}) == 8  # every caller gets its own copy
+    assert (cache.stats.misses, cache.stats.coalesced) == (1, 7)
+
+
+def test_exception_reaches_every_waiter_and_is_not_memoized():
+    cache, release = SnapshotCache(), threading.Event()
+
+    def fn():
+        release.wait()
+        raise ConnectionError("node down")
+
+    results = _run_concurrently(cache, fn, 4, release)
+
+    assert all(isinstance(r, ConnectionError) for r in results)
+    assert cache.get_or_call('key', lambda: 'recovered') == 'recovered'
+
+
+def test_latest_results_expire_after_ttl():
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return {'block': 100 + len(calls), 'results': []}
+
+    cache = SnapshotCache(ttl=60)
+    first = cache.get_or_call(('q', 0), fn, latest_key=lambda r: ('q', r['block']))
+    assert cache.get_or_call(('q', 0), fn, latest_key=lambda r: ('q', r['block'])) == first
+    assert cache.get_or_call(('q', 101), fn) == first  # keyed by the resolved block as well
+    assert (len(calls), cache.stats.hits) == (1, 2)
+
+    cache = SnapshotCache(ttl=0)
+    cache.get_or_call(('q', 0), fn, latest_key=lambda r: ('q', r['block']))
+    cache.get_or_call(('q', 0), fn, latest_key=lambda r: ('q', r['block']))
+    assert len(calls) == 3
+
+
+def test_historical_results_never_expire_but_are_bounded():
+    cache, calls = SnapshotCache(ttl=0, max_entries=2), []
+
+    def fetch(block):
+        return cache.get_or_call(('q', block), lambda: calls.append(block) or {'block': block, 'results': []})
+
+    for block in [1, 2, 1, 3, 1, 2]:
+        fetch(block)
+
+    assert calls == [1, 2, 3, 2]
+
+
+def test_results_are_copies():
+    cache = SnapshotCache()
+    cache.get_or_call('key', lambda: {'block': 1, 'results': [{'price': 1}]})['results'][0]['price'] = 0
+    cache.get_or_call('key', lambda: None)['results'].clear()
+
+    assert cache.get_or_call('key', lambda: None) == {'block': 1, 'results': [{'price': 1}]}
+
+
+def test_abis_and_contracts_are_built_once(tmp_path):
+    abi_file = tmp_path / 'abi.json'
+    abi_file.write_text(json.dumps([{'name': 'allMarketSummaries'}]))
+
+    class Eth:
+        def contract(self, address, abi):
+            return (address, id(abi))
+
+    class Node:
+        eth = Eth()
+
+    registry, node = ContractRegistry(), Node()
+    contracts = [registry.get_contract(node, address, str(abi_file)) for address in ['0xa', '0xb', '0xa', '0xb']]
+
+    assert contracts[0] == contracts[2] and contracts[1] == contracts[3] and contracts[0] != contracts[1]
+    assert registry.get_contract(Node(), '0xa', str(abi_file)) is not contracts[0]
+    assert (registry.stats.abi_loads, registry.stats.contract_builds) == (1, 3)
+
+
+@pytest.fixture
+def pipe(monkeypatch):
+    calls = []
+
+    def fake_summaries(self, block=0):
+        calls.append(block)
+        block = block or 123
+        return {'block': block, 'timestamp': 1_700_000_000 + block, 'results': [{'market': '0x1', 'price': block}]}
+
+    monkeypatch.setattr(SNXMarketPipe, 'snapshot_cache', SnapshotCache())
+    monkeypatch.setattr(SNXMarketPipe, '_get_all_market_summaries', fake_summaries)
+    pipe = SNXMarketPipe()
+    pipe.calls = calls
+    return pipe
+
+
+def test_pipe_shares_latest_with_resolved_block(pipe):
+    latest = pipe.get_all_market_summaries()
+    latest['results'].clear()
+
+    assert pipe.get_all_market_summaries(123) == pipe.get_all_market_summaries(0)
+    assert pipe.get_all_market_summaries(123)['results'] == [{'market': '0x1', 'price': 123}]
+    assert pipe.calls == [0]
+    assert pipe.cache_stats()['hits'] == 3
+
+
+def test_pipe_async_wrappers_share_one_call(pipe):
+    async def main():
+        return await asyncio.gather(*[pipe.get_all_market_summaries_async(5) for _ in range(10)])
+
+    results = asyncio.run(main())
+
+    assert all(r['block'] == 5 for r in results)
+    assert pipe.calls == [5]
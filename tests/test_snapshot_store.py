@@ -0,0 +1,158 @@
+import pytest
+
+from perpv2_market_api.snapshot_store import SnapshotStore
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'market_summaries.snxs')
+
+
+def test_keyframe_delta_round_trip(store_path, history_factory):
+    history = history_factory(n_blocks=100)
+
+    with SnapshotStore(store_path, keyframe_interval=30) as store:
+        store.extend(history)
+
+    store = SnapshotStore(store_path)
+    assert list(store.iter_snapshots()) == history
+    assert store.blocks() == [s['block'] for s in history]
+    assert len(store._index()) == 4
+
+
+def test_markets_added_removed_and_reordered(store_path, history_factory):
+    history = history_factory(n_blocks=6)
+    history[1]['results'] = history[1]['results'][1:]                       # removed
+    history[2]['results'] = history[2]['results'][1:] + history[2]['results'][:1]  # added back
+    history[3]['results'] = history[3]['results'][::-1]                      # reordered
+    history[4]['results'] = []                                               # no markets
+
+    with SnapshotStore(store_path) as store:
+        store.extend(history)
+
+    store = SnapshotStore(store_path)
+    for snapshot in history:
+        assert store.read_block(snapshot['block']) == snapshot
+
+
+def test_negative_and_large_ints(store_path, history_factory):
+    history = history_factory(n_blocks=3)
+    history[0]['results'][0]['marketSkew'] = -2**200
+    history[1]['results'][0]['marketSkew'] = 2**70
+    history[1]['results'][1]['marketDebt'] = 2**255 - 1
+    history[2]['results'][1]['marketDebt'] = -1
+
+    with SnapshotStore(store_path) as store:
+        store.extend(history)
+
+    assert list(SnapshotStore(store_path).iter_snapshots()) == history
+
+
+def test_rejects_duplicate_markets(store_path, history_factory):
+    history = history_factory(n_blocks=1)
+    history[0]['results'].append(history[0]['results'][0])
+
+    store = SnapshotStore(store_path)
+    store.extend(history)
+
+    with pytest.raises(ValueError):
+        store.flush()
+
+
+def test_empty_results(store_path):
+    history = [{'block': 1, 'timestamp': 10, 'results': []}, {'block': 2, 'timestamp': 12, 'results': []}]
+
+    with SnapshotStore(store_path) as store:
+        store.extend(history)
+
+    assert list(SnapshotStore(store_path).iter_snapshots()) == history
+
+
+def test_reopen_and_read_across_segments(store_path, history_factory):
+    history = history_factory(n_blocks=25)
+
+    with SnapshotStore(store_path, keyframe_interval=10) as store:
+        store.extend(history[:15])
+    with SnapshotStore(store_path, keyframe_interval=10) as store:
+        store.extend(history[15:])
+
+    store = SnapshotStore(store_path)
+    assert [(s.first_block, s.last_block) for s in store._index()] == [
+        (history[i]['block'], history[j]['block']) for i, j in [(0, 9), (10, 14), (15, 24)]
+    ]
+    for snapshot in reversed(history):
+        assert store.read_block(snapshot['block']) == snapshot
+    assert store.read_block(history[-1]['block'] + 1) is None
+    assert list(store.iter_snapshots(history[8]['block'], history[16]['block'])) == history[8:17]
+
+
+def test_out_of_order_appends(store_path, history_factory):
+    history = history_factory(n_blocks=20)
+
+    with SnapshotStore(store_path) as store:
+        store.extend(history[10:])
+        store.extend(history[:10])
+
+    store = SnapshotStore(store_path)
+    assert len(store._index()) == 1  # buffered snapshots are sorted, not flushed early
+    assert store.blocks() == [s['block'] for s in history]
+    assert list(store.iter_snapshots()) == history
+    for snapshot in history:
+        assert store.read_block(snapshot['block']) == snapshot
+
+
+def test_overlapping_segments_are_merged(store_path, history_factory):
+    history = history_factory(n_blocks=40)
+
+    store = SnapshotStore(store_path, keyframe_interval=7)
+    store.extend(history[1::2])
+    store.flush()
+    store.extend(history[::2][::-1])
+    store.extend(history[-3:])  # appended again, still pending
+
+    def check(s: SnapshotStore):
+        assert list(s.iter_snapshots()) == history
+        assert list(s.iter_snapshots(history[5]['block'], history[30]['block'])) == history[5:31]
+        assert [s.read_block(snapshot['block']) for snapshot in history] == history
+
+    check(store)
+    store.close()
+    check(SnapshotStore(store_path))
+
+
+def test_index_matches_segments(store_path, history_factory):
+    history = history_factory(n_blocks=60)
+
+    with SnapshotStore(store_path, keyframe_interval=4) as store:
+        store.extend(history[30:])
+        store._index()
+        store.extend(history[:30])  # segments inserted before existing ones
+
+    for s in [store, SnapshotStore(store_path)]:
+        segments = s._index()
+        assert s._first_blocks == [seg.first_block for seg in segments]
+        assert s._max_last_block == [max(seg.last_block for seg in segments[:i + 1]) for i in range(len(segments))]
+
+
+def test_returned_snapshots_are_copies(store_path, history_factory):
+    history = history_factory(n_blocks=5)
+    store = SnapshotStore(store_path)
+    store.extend(history)
+
+    store.read_block(history[0]['block'])['results'][0]['price'] = 0   # pending
+    store.flush()
+    next(store.iter_snapshots())['results'][0]['price'] = 0           # cached segment
+    store.read_block(history[1]['block'])['results'].clear()
+
+    assert list(store.iter_snapshots()) == history
+
+
+def test_rejects_corrupted_file(store_path, history_factory):
+    with SnapshotStore(store_path) as store:
+        store.extend(history_factory(n_blocks=2))
+
+    with open(store_path, 'r+b') as f:
+        f.write(b'XXXX')
+
+    with pytest.raises(ValueError):
+        SnapshotStore(store_path).read_block(0)